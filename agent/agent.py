@@ -4,9 +4,13 @@ import json
 import logging
 import os
 import re
-from dataclasses import dataclass
-from typing import Any
+import threading
+import time
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Iterable
 
+import orjson
 from google import genai
 
 from api.models import UploadFile, Category
@@ -14,6 +18,36 @@ from api.models import UploadFile, Category
 # Configure logger
 logger = logging.getLogger(__name__)
 
+gemini_model_id = 'gemini-2.5-flash-lite'
+json_decoder = json.JSONDecoder()
+# Leading ```json / ``` fence and trailing ``` fence of a markdown-wrapped response
+markdown_fence_pattern = re.compile(r'^\s*```(?:json)?\s*|\s*```\s*$')
+
+
+class RequestRateLimiter:
+    """Spaces requests evenly so that the threads of a process together stay under a requests-per-minute quota"""
+
+    def __init__(self, requests_per_minute: int) -> None:
+        # A non-positive quota disables the limiter
+        self.interval = 60.0 / requests_per_minute if requests_per_minute > 0 else 0.0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Blocks the calling thread until its request slot comes"""
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+# Shared by every call_gemini_api of the process, like the cached client (GEMINI_RPM_LIMIT=0 means no limit)
+gemini_rate_limiter = RequestRateLimiter(int(os.getenv('GEMINI_RPM_LIMIT', '0')))
+
 
 def get_api_key() -> str:
     """Get API key from environment variable"""
@@ -27,7 +61,13 @@ def get_api_key() -> str:
     return api_key
 
 
-@dataclass
+@lru_cache(maxsize=None)
+def get_gemini_client(api_key: str) -> genai.Client:
+    """Shared client per API key: agents reuse its HTTP connection pool instead of opening new connections"""
+    return genai.Client(api_key=api_key)
+
+
+@dataclass(slots=True, frozen=True)
 class GeminiResponse:
     text: str
     prompt_tokens: int
@@ -35,13 +75,31 @@ class GeminiResponse:
     model_name: str
 
 
-def call_gemini_api(prompt: str, client: genai.Client, temperature: float = 0.1) -> GeminiResponse:
-    """Make request to Gemini API using the new SDK"""
-    model_id = 'gemini-2.5-flash-lite'
+def call_gemini_api(prompt: str, client: genai.Client, temperature: float = 0.1,
+                    response_schema: dict[str, Any] | None = None, stream: bool = False,
+                    cached_content: str | None = None) -> GeminiResponse:
+    """
+    Make request to Gemini API using the new SDK.
+    When a response schema is given, the model answers in JSON mode with a body matching it.
+    When stream is set, the answer is received as it is generated and accumulated chunk by chunk.
+    When cached_content is given, the prompt is appended to that cached context (see caches.create).
+    Requests are paced by gemini_rate_limiter.
+    """
+    model_id = gemini_model_id
+    gemini_rate_limiter.acquire()
     try:
         config = genai.types.GenerateContentConfig(
             temperature=temperature,
+            response_mime_type='application/json' if response_schema else None,
+            response_schema=response_schema,
+            cached_content=cached_content,
         )
+        if stream:
+            return _collect_streamed_response(
+                client.models.generate_content_stream(model=model_id, contents=prompt, config=config),
+                model_id
+            )
+
         response = client.models.generate_content(
             model=model_id,
             contents=prompt,
@@ -56,46 +114,113 @@ def call_gemini_api(prompt: str, client: genai.Client, temperature: float = 0.1)
         )
 
     except Exception as e:
-        raise Exception(f"API request failed: {e}")
+        raise Exception(f"API request failed: {e}") from e
+
+
+# HTTP status codes of Gemini errors that may succeed on a later attempt: timeouts, rate limiting, server failures
+gemini_retryable_status_codes = frozenset({408, 429, 500, 502, 503, 504})
+
+
+def _find_gemini_api_error(error: BaseException | None) -> genai.errors.APIError | None:
+    """Returns the Gemini API error behind a wrapped exception (see call_gemini_api), None for other failures"""
+    while error is not None and not isinstance(error, genai.errors.APIError):
+        error = error.__cause__
+    return error
+
+
+def is_prompt_cache_error(error: BaseException) -> bool:
+    """
+    True when Gemini rejected the request because its cached context expired or no longer exists:
+    the request succeeds once the cache is created again.
+    """
+    api_error = _find_gemini_api_error(error)
+    return (api_error is not None and api_error.code in (400, 403, 404)
+            and 'cache' in (api_error.message or '').lower())
+
+
+def is_retryable_gemini_error(error: BaseException) -> bool:
+    """
+    False for Gemini client errors (bad request, invalid key, missing permission, unknown model):
+    they fail the same way on every attempt. Network errors, unparsable answers and expired
+    prompt caches (recreated on the next attempt) are worth another try.
+    """
+    api_error = _find_gemini_api_error(error)
+    if api_error is None:
+        return True
+    return api_error.code in gemini_retryable_status_codes or is_prompt_cache_error(api_error)
+
+
+def gemini_retry_delay(error: BaseException) -> float | None:
+    """
+    Seconds Gemini asks to wait before retrying (RetryInfo of a quota error or the Retry-After header), None when absent.
+    """
+    error = _find_gemini_api_error(error)
+    if error is None:
+        return None
+
+    details = error.details.get('error', error.details).get('details', []) if isinstance(error.details, dict) else []
+    for detail in details:
+        retry_delay = detail.get('retryDelay') if isinstance(detail, dict) else None
+        if isinstance(retry_delay, str) and retry_delay.endswith('s'):
+            try:
+                return float(retry_delay[:-1])
+            except ValueError:
+                pass
+
+    retry_after = getattr(getattr(error, 'response', None), 'headers', {}).get('Retry-After')
+    try:
+        return float(retry_after) if retry_after is not None else None
+    except ValueError:
+        # HTTP dates are not used by Gemini
+        return None
+
+
+def _collect_streamed_response(chunks: Iterable[Any], model_id: str) -> GeminiResponse:
+    """Join the text deltas of a streamed answer, token usage is reported on the last chunks"""
+    text_parts = []
+    usage_metadata = None
+    for chunk in chunks:
+        if chunk.text:
+            text_parts.append(chunk.text)
+        usage_metadata = chunk.usage_metadata or usage_metadata
+
+    return GeminiResponse(
+        text=''.join(text_parts),
+        prompt_tokens=usage_metadata.prompt_token_count if usage_metadata else 0,
+        candidate_tokens=usage_metadata.candidates_token_count if usage_metadata else 0,
+        model_name=model_id
+    )
 
 
 def parse_json_array(response_text: str) -> list[dict]:
     """Parse JSON array response from LLM"""
     try:
-        cleaned_text = response_text.strip()
-
         # Remove markdown formatting
-        if cleaned_text.startswith("```json"):
-            cleaned_text = cleaned_text[7:]
-        if cleaned_text.startswith("```"):
-            cleaned_text = cleaned_text[3:]
-        if cleaned_text.endswith("```"):
-            cleaned_text = cleaned_text[:-3]
-
-        cleaned_text = cleaned_text.strip()
+        cleaned_text = markdown_fence_pattern.sub('', response_text).strip()
+
+        # Fast path: in JSON mode the body is the bare array
+        if cleaned_text.startswith("[") and cleaned_text.endswith("]"):
+            try:
+                result = orjson.loads(cleaned_text)
+            except orjson.JSONDecodeError:
+                pass
+            else:
+                if isinstance(result, list):
+                    return result
 
         # Find JSON array boundaries
         start_bracket = cleaned_text.find("[")
         if start_bracket == -1:
             raise ValueError("No opening bracket found - expected JSON array")
 
-        bracket_count = 0
-        last_valid_pos = -1
-
-        for i in range(start_bracket, len(cleaned_text)):
-            if cleaned_text[i] == '[':
-                bracket_count += 1
-            elif cleaned_text[i] == ']':
-                bracket_count -= 1
-                if bracket_count == 0:
-                    last_valid_pos = i + 1
-                    break
-
-        if last_valid_pos == -1:
-            raise ValueError("No matching closing bracket found - JSON array appears truncated")
-
-        json_text = cleaned_text[start_bracket:last_valid_pos]
-        result = json.loads(json_text)
+        # Decode the value starting at the bracket: the decoder stops right after its matching closing bracket,
+        # ignoring any trailing text and any bracket inside string values
+        try:
+            result, _ = json_decoder.raw_decode(cleaned_text, start_bracket)
+        except json.JSONDecodeError as e:
+            if e.pos >= len(cleaned_text) or e.msg.startswith("Unterminated string"):
+                raise ValueError("No matching closing bracket found - JSON array appears truncated")
+            raise
 
         if not isinstance(result, list):
             raise ValueError("Expected JSON array, got object instead")
@@ -108,8 +233,8 @@ def parse_json_array(response_text: str) -> list[dict]:
 
 def parse_llm_response_json(llm_response_text: str) -> dict[str, Any]:
     """
-    Safely extracts and parses a JSON string embedded within a markdown code block
-    (```json ... ```) from the LLM's response.
+    Safely extracts and parses a JSON object from the LLM's response: a bare object (JSON mode),
+    or one embedded in a markdown code block (```json ... ```) or in surrounding text.
 
     Args:
         llm_response_text: The full string response from the LLM agent.
@@ -119,31 +244,77 @@ def parse_llm_response_json(llm_response_text: str) -> dict[str, Any]:
         if parsing fails.
     """
 
-    # Use a regular expression to find the JSON content inside the markdown block
-    json_match = re.search(r"```json\s*(.*?)\s*```", llm_response_text, re.DOTALL)
-
-    if not json_match:
-        logger.error("Could not find JSON content inside ```json ... ``` block.")
+    # Fast path: a bare object is parsed as it is
+    stripped_text = llm_response_text.strip()
+    if stripped_text.startswith("{") and stripped_text.endswith("}"):
+        try:
+            parsed_data = orjson.loads(stripped_text)
+        except orjson.JSONDecodeError:
+            pass
+        else:
+            if isinstance(parsed_data, dict):
+                return parsed_data
+
+    start_brace = stripped_text.find("{")
+    if start_brace == -1:
+        logger.error("Could not find a JSON object in the response.")
         return {}
 
-    # Extract the raw JSON string
-    raw_json_string = json_match.group(1)
-
-    # Clean the string: remove common LLM artifacts like backticks or extra whitespace
-    raw_json_string = raw_json_string.strip()
-
     try:
-        # Parse the JSON string into a Python dictionary
-        parsed_data = json.loads(raw_json_string)
-        return parsed_data
-
+        # Decode the object starting at the brace: fences and any text after the object are ignored
+        parsed_data, _ = json_decoder.raw_decode(stripped_text, start_brace)
     except json.JSONDecodeError as e:
         logger.error(f"Failed to decode JSON. Check for malformed data. JSON Error: {e}")
-        logger.debug(f"Problematic string: {raw_json_string}")
+        # Lazy formatting: the (possibly large) string is only rendered when debug logging is on
+        logger.debug("Problematic string: %s", stripped_text)
         return {}
 
-
-@dataclass
+    return parsed_data
+
+
+# JSON mode schema of the batch categorization answer, same fields (and order) as the prompt example
+categorization_response_schema = {
+    'type': 'ARRAY',
+    'items': {
+        'type': 'OBJECT',
+        'properties': {
+            'transaction_id': {'type': 'STRING'},
+            'date': {'type': 'STRING'},
+            'category': {'type': 'STRING'},
+            'merchant': {'type': 'STRING'},
+            'amount': {'type': 'NUMBER'},
+            'original_amount': {'type': 'STRING'},
+            'description': {'type': 'STRING'},
+            'reasoning': {'type': 'STRING'},
+            'applied_user_rule': {'type': 'STRING', 'nullable': True},
+            'failure': {'type': 'BOOLEAN'},
+        },
+        'required': ['transaction_id', 'date', 'category', 'merchant', 'amount', 'original_amount', 'description',
+                     'reasoning'],
+        'property_ordering': ['transaction_id', 'date', 'category', 'merchant', 'amount', 'original_amount',
+                              'description', 'reasoning', 'applied_user_rule', 'failure'],
+    },
+}
+
+# JSON mode schema of the CSV structure answer: it replaces the output format block of the prompt
+csv_structure_field_names = ['description_field', 'merchant_field', 'transaction_date_field', 'expense_amount_field',
+                             'income_amount_field', 'operation_type_field']
+csv_structure_response_schema = {
+    'type': 'OBJECT',
+    'properties': {
+        **{
+            field_name: {'type': 'STRING', 'nullable': True, 'description': 'Nome della colonna esattamente come appare nei dati, o null'}
+            for field_name in csv_structure_field_names
+        },
+        'confidence': {'type': 'STRING', 'enum': ['high', 'medium', 'low']},
+        'notes': {'type': 'STRING', 'description': 'Spiegazione dettagliata delle scelte fatte'},
+    },
+    'required': csv_structure_field_names + ['confidence', 'notes'],
+    'property_ordering': csv_structure_field_names + ['confidence', 'notes'],
+}
+
+
+@dataclass(slots=True)
 class TransactionCategorization:
     """Structured result for a single transaction categorization"""
     transaction_id: str
@@ -176,15 +347,29 @@ class TransactionCategorization:
         )
 
 
-@dataclass
+@dataclass(slots=True)
 class AgentTransactionUpload:
     transaction_id: int
     raw_text: dict[str, Any]
     rag_context: list[dict[str, Any]] = None
+    # RAW DATA lines of the batch prompt, formatted on first use and reused when the batch is retried
+    raw_text_lines: str | None = field(default=None, repr=False, compare=False)
+
+
+def truncate_prompt_value(value: Any, max_length: int) -> str:
+    """Stringifies a raw field once, truncating it to max_length characters for token efficiency"""
+    display_value = str(value)
+    return display_value[:max_length] + "..." if len(display_value) > max_length else display_value
 
 
+def format_raw_text_lines(raw_text: dict[str, Any]) -> str:
+    """Formats the raw fields of a transaction as batch prompt lines, truncating very long values"""
+    return "".join(
+        f"   - {column}: {truncate_prompt_value(value, 200)}\n" for column, value in raw_text.items() if column != 'id'
+    )
 
-@dataclass
+
+@dataclass(slots=True, frozen=True)
 class CsvStructure:
     """Structured CSV structure detection result"""
     description_field: str | None
@@ -213,6 +398,10 @@ class CsvStructure:
 
 class ExpenseCategorizerAgent:
     """Agent for categorizing expense transactions using LLM"""
+    stream_responses = os.getenv('GEMINI_STREAM_RESPONSES', 'False').lower() == 'true'
+    # Explicit context caching of the static prompt prefix (billed at the cached-token rate on every batch)
+    context_cache_enabled = os.getenv('GEMINI_CONTEXT_CACHE', 'False').lower() == 'true'
+    context_cache_ttl = os.getenv('GEMINI_CONTEXT_CACHE_TTL', '900s')
 
     def __init__(self, api_key: str | None = None, user_rules: list[str] | None = None,
                  available_categories: list[Category] | None = None) -> None:
@@ -223,9 +412,15 @@ class ExpenseCategorizerAgent:
             available_categories: list of available categories
         """
         self.api_key = api_key or get_api_key()
-        self.client = genai.Client(api_key=self.api_key)
+        self.client = get_gemini_client(self.api_key)
         self.available_categories = available_categories or []
         self.user_rules = user_rules or []
+        self._static_prompt_prefix = self._build_static_prompt_prefix()
+        # Name of the cached context holding the static prefix: None until created, '' when unavailable
+        self._prompt_cache_name: str | None = None
+        self._prompt_cache_lock = threading.Lock()
+        # CSV hints only depend on the upload: they are rendered once per saved upload file
+        self._csv_hints_by_upload_id: dict[int, str] = {}
 
     def detect_csv_structure(
             self,
@@ -235,24 +430,24 @@ class ExpenseCategorizerAgent:
         """
         Analyze the CSV structure using Gemini to identify column mappings.
         """
-        # Build the prompt
-        samples_text = ""
-        for i, tx in enumerate(transactions):
-            index = i + 1
-            samples_text += f"Transazione {index}:\n"
-            samples_text += f"  ID: {tx.transaction_id}\n"
-            samples_text += "  Campi:\n"
-            for column, value in tx.raw_text.items():
-                # Truncate long values for token efficiency
-                display_value = str(value)[:100] + "..." if len(str(value)) > 100 else value
-                samples_text += f"    - {column}: {display_value}\n"
-            samples_text += "\n"
-
+        # Build the prompt (lines are joined once at the end)
+        sample_lines = []
+        for index, tx in enumerate(transactions, 1):
+            sample_lines.append(f"Transazione {index}:\n")
+            sample_lines.append(f"  ID: {tx.transaction_id}\n")
+            sample_lines.append("  Campi:\n")
+            sample_lines.extend(
+                f"    - {column}: {truncate_prompt_value(value, 100)}\n" for column, value in tx.raw_text.items()
+            )
+            sample_lines.append("\n")
+        samples_text = "".join(sample_lines)
+
+        # The note and the samples vary between uploads: they close the prompt, so the instructions stay a fixed prefix
         prompt_context = ""
         if known_date_column:
-            prompt_context = f"\n\nNOTA: Abbiamo già identificato che il campo della data è '{known_date_column}'. Utilizzalo come transaction_date_field e concentrati sull'identificazione degli altri campi."
+            prompt_context = f"NOTA: Abbiamo già identificato che il campo della data è '{known_date_column}'. Utilizzalo come transaction_date_field e concentrati sull'identificazione degli altri campi.\n\n"
 
-        prompt = f"""Sei un esperto nell'analisi di strutture dati di transazioni bancarie italiane.{prompt_context}
+        prompt = f"""Sei un esperto nell'analisi di strutture dati di transazioni bancarie italiane.
 
             Analizza i seguenti campioni di transazioni e identifica quali campi corrispondono a:
             1. **description_field**: Il campo contenente la descrizione/dettagli della transazione
@@ -347,37 +542,24 @@ class ExpenseCategorizerAgent:
             - "Osservazioni" contiene dettagli estesi con codici carta, località → description_field (contiene più informazioni)
             - "Importo" contiene valori numerici con segno → expense_amount_field E income_amount_field
 
-            FORMATO OUTPUT (JSON):
-            {{
-              "description_field": "nome_colonna_esatto_o_null",
-              "merchant_field": "nome_colonna_esatto_o_null",
-              "transaction_date_field": "nome_colonna_esatto_o_null",
-              "expense_amount_field": "nome_colonna_esatto_o_null",
-              "income_amount_field": "nome_colonna_esatto_o_null",
-              "operation_type_field": "nome_colonna_esatto_o_null",
-              "confidence": "high|medium|low",
-              "notes": "string con spiegazione dettagliata delle scelte fatte"
-            }}
-
-            CAMPIONI DI TRANSAZIONI:
-            {samples_text}
-
-            Restituisci SOLO l'oggetto JSON, nient'altro."""
+            {prompt_context}CAMPIONI DI TRANSAZIONI:
+            {samples_text}"""
 
+        response = None
         try:
-            response = call_gemini_api(prompt=prompt, client=self.client, temperature=1.0)
-            # Parse the response
+            # JSON mode: the body is the bare object described by csv_structure_response_schema
+            response = call_gemini_api(prompt=prompt, client=self.client, temperature=1.0,
+                                       response_schema=csv_structure_response_schema)
             result_dict = parse_llm_response_json(response.text)
-
             if not result_dict:
-                # Fallback: try direct JSON parsing
-                import json
-                result_dict = json.loads(response.text.strip())
+                raise ValueError("Empty or invalid CSV structure response")
 
             return CsvStructure.from_dict(result_dict), response
 
         except Exception as e:
             logger.error(f"CSV structure detection failed: {e}")
+            if response is not None:
+                logger.error(f"Unparsable response text: {(response.text or '')[:2000]}")
             # Return empty structure on failure
             return CsvStructure(
                 description_field=None,
@@ -390,9 +572,12 @@ class ExpenseCategorizerAgent:
                 notes=f"Rilevamento fallito: {str(e)}"
             ), None
 
-    def build_batch_prompt(self, batch: list[AgentTransactionUpload], upload_file: UploadFile) -> str:
-        """Costruisce il prompt per un batch di transazioni"""
-
+    def _build_static_prompt_prefix(self) -> str:
+        """
+        Builds the part of the batch prompt that only depends on the agent configuration (user rules and
+        categories). It is computed once per agent and emitted byte-identical at the start of every batch prompt,
+        so that Gemini implicit prefix caching can skip re-processing it.
+        """
         logic_constraints = """
             ══════════════════════════════════════════════════════
             ⚠️ REGOLE UNIVERSALI DI CLASSIFICAZIONE
@@ -415,52 +600,6 @@ class ExpenseCategorizerAgent:
                - **IMPORTANTE**: Se un esempio simile corrisponde bene alla transazione attuale, segui la stessa categorizzazione (categoria e merchant) per garantire coerenza con lo storico dell'utente.
         """
 
-        # Formatta le transazioni
-        transactions_text = ""
-        for i, tx in enumerate(batch, 1):
-            transactions_text += f"{i}. TRANSACTION_ID: {tx.transaction_id}\n"
-            transactions_text += "   RAW DATA:\n"
-            for column, value in tx.raw_text.items():
-                if column != 'id':
-                    # Tronca i valori molto lunghi
-                    display_value = str(value)[:200] + "..." if len(str(value)) > 200 else value
-                    transactions_text += f"   - {column}: {display_value}\n"
-            
-            if tx.rag_context:
-                transactions_text += "   ESEMPI SIMILI DAL PASSATO:\n"
-                for ctx in tx.rag_context:
-                    transactions_text += f"     • Descrizione: {ctx['description']} | Mercante: {ctx['merchant']} | Categoria: {ctx['category']}\n"
-            
-            transactions_text += "\n"
-
-        # Build CSV structure hints section
-        csv_hints_section = ""
-        if upload_file:
-            csv_hints_section = """
-            ═══════════════════════════════════════════════════════════════════
-            📋 INFORMAZIONI STRUTTURA CSV - SUGGERIMENTI PER L'ESTRAZIONE 📋
-            ═══════════════════════════════════════════════════════════════════
-
-            Per aiutarti nell'estrazione dei dati, ecco le informazioni sulla struttura CSV identificata:
-            """
-            if upload_file.description_column_name:
-                csv_hints_section += f"📝 **DESCRIPTION FIELD**: Il campo '{upload_file.description_column_name}' contiene la descrizione della transazione.\n"
-            if upload_file.merchant_column_name:
-                csv_hints_section += f"🏪 **MERCHANT FIELD**: Il campo '{upload_file.merchant_column_name}' contiene informazioni sul commerciante/beneficiario.\n"
-            if upload_file.date_column_name:
-                csv_hints_section += f"📅 **DATE FIELD**: Il campo '{upload_file.date_column_name}' contiene la data della transazione.\n"
-            if upload_file.income_amount_column_name or upload_file.expense_amount_column_name:
-                csv_hints_section += f"💰 **AMOUNT FIELD**: Il campo '{upload_file.income_amount_column_name} oppure {upload_file.expense_amount_column_name}' contiene l'importo della transazione.\n"
-            if upload_file.operation_type_column_name:
-                csv_hints_section += f"🔄 **OPERATION TYPE FIELD**: Il campo '{upload_file.operation_type_column_name}' contiene il tipo di operazione.\n"
-            if upload_file.notes:
-                csv_hints_section += f"\n📌 **NOTE SULLA STRUTTURA CSV**:\n{upload_file.notes}\n"
-
-            csv_hints_section += """
-            ⚠️ IMPORTANTE: Usa questi suggerimenti come guida principale per identificare e estrarre i campi corretti.
-            Questi mapping sono stati identificati automaticamente analizzando la struttura del CSV.
-            """
-
         # Costruisce la sezione delle regole utente
         user_rules_section = ""
         critical_rules = [
@@ -486,9 +625,9 @@ class ExpenseCategorizerAgent:
             Non saltare transazioni a meno che non siano esplicitamente vietate dalle regole sopra (Saldo o Accrediti).
             """
 
-        # Format categories as "KEY": Description
+        # Format categories as "KEY": Description, sorted by name so the prefix does not depend on the caller's order
         categories_formatted_list = []
-        for cat in self.available_categories:
+        for cat in sorted(self.available_categories, key=lambda category: category.name):
             if cat.name not in ['not_expense', 'Altro', 'altro']:
                 if cat.description:
                     categories_formatted_list.append(f'  • "{cat.name}": {cat.description}')
@@ -499,8 +638,6 @@ class ExpenseCategorizerAgent:
 
         return f"""Sei un assistente IA specializzato nella categorizzazione delle **spese** bancarie italiane.
 
-    {csv_hints_section}
-
     {user_rules_section}
 
     {logic_constraints}
@@ -704,6 +841,74 @@ class ExpenseCategorizerAgent:
         "failure": false
       }}
     ]
+"""
+
+    @staticmethod
+    def _build_csv_hints_section(upload_file: UploadFile) -> str:
+        if not upload_file:
+            return ""
+
+        hint_lines = ["""
+            ═══════════════════════════════════════════════════════════════════
+            📋 INFORMAZIONI STRUTTURA CSV - SUGGERIMENTI PER L'ESTRAZIONE 📋
+            ═══════════════════════════════════════════════════════════════════
+
+            Per aiutarti nell'estrazione dei dati, ecco le informazioni sulla struttura CSV identificata:
+            """]
+        if upload_file.description_column_name:
+            hint_lines.append(f"📝 **DESCRIPTION FIELD**: Il campo '{upload_file.description_column_name}' contiene la descrizione della transazione.\n")
+        if upload_file.merchant_column_name:
+            hint_lines.append(f"🏪 **MERCHANT FIELD**: Il campo '{upload_file.merchant_column_name}' contiene informazioni sul commerciante/beneficiario.\n")
+        if upload_file.date_column_name:
+            hint_lines.append(f"📅 **DATE FIELD**: Il campo '{upload_file.date_column_name}' contiene la data della transazione.\n")
+        if upload_file.income_amount_column_name or upload_file.expense_amount_column_name:
+            hint_lines.append(f"💰 **AMOUNT FIELD**: Il campo '{upload_file.income_amount_column_name} oppure {upload_file.expense_amount_column_name}' contiene l'importo della transazione.\n")
+        if upload_file.operation_type_column_name:
+            hint_lines.append(f"🔄 **OPERATION TYPE FIELD**: Il campo '{upload_file.operation_type_column_name}' contiene il tipo di operazione.\n")
+        if upload_file.notes:
+            hint_lines.append(f"\n📌 **NOTE SULLA STRUTTURA CSV**:\n{upload_file.notes}\n")
+
+        hint_lines.append("""
+            ⚠️ IMPORTANTE: Usa questi suggerimenti come guida principale per identificare e estrarre i campi corretti.
+            Questi mapping sono stati identificati automaticamente analizzando la struttura del CSV.
+            """)
+
+        return "".join(hint_lines)
+
+    def build_batch_prompt(self, batch: list[AgentTransactionUpload], upload_file: UploadFile) -> str:
+        """Costruisce il prompt per un batch di transazioni"""
+        return self._static_prompt_prefix + self._build_batch_prompt_tail(batch, upload_file)
+
+    def _build_batch_prompt_tail(self, batch: list[AgentTransactionUpload], upload_file: UploadFile) -> str:
+        """Parte variabile del prompt (suggerimenti CSV e transazioni), da accodare al prefisso statico"""
+
+        # Formatta le transazioni (le righe vengono unite una sola volta alla fine)
+        lines = []
+        for i, tx in enumerate(batch, 1):
+            lines.append(f"{i}. TRANSACTION_ID: {tx.transaction_id}\n")
+            lines.append("   RAW DATA:\n")
+            if tx.raw_text_lines is None:
+                tx.raw_text_lines = format_raw_text_lines(tx.raw_text)
+            lines.append(tx.raw_text_lines)
+
+            if tx.rag_context:
+                lines.append("   ESEMPI SIMILI DAL PASSATO:\n")
+                for ctx in tx.rag_context:
+                    lines.append(f"     • Descrizione: {ctx['description']} | Mercante: {ctx['merchant']} | Categoria: {ctx['category']}\n")
+
+            lines.append("\n")
+        transactions_text = "".join(lines)
+
+        upload_id = upload_file.pk if upload_file else None
+        csv_hints_section = self._csv_hints_by_upload_id.get(upload_id) if upload_id else None
+        if csv_hints_section is None:
+            csv_hints_section = self._build_csv_hints_section(upload_file)
+            if upload_id:
+                self._csv_hints_by_upload_id[upload_id] = csv_hints_section
+
+        # Only the CSV hints and the transactions vary between calls: they go after the static prefix
+        return f"""
+    {csv_hints_section}
 
     ═══════════════════════════════════════════════════════
     TRANSAZIONI DA ANALIZZARE:
@@ -712,6 +917,47 @@ class ExpenseCategorizerAgent:
 
     RISPONDI SOLO CON L'ARRAY JSON:"""
 
+    def _get_prompt_cache_name(self) -> str | None:
+        """
+        Returns the cached context holding the static prompt prefix, creating it on first use.
+        Batches run in parallel threads, so creation is serialized. When caching is disabled or the
+        cache cannot be created (e.g. prefix below the model minimum), full prompts are sent instead.
+        """
+        if not self.context_cache_enabled:
+            return None
+        with self._prompt_cache_lock:
+            if self._prompt_cache_name is None:
+                try:
+                    cache = self.client.caches.create(
+                        model=gemini_model_id,
+                        config=genai.types.CreateCachedContentConfig(
+                            contents=[self._static_prompt_prefix],
+                            ttl=self.context_cache_ttl,
+                            display_name='expense-categorizer-prompt-prefix'
+                        )
+                    )
+                    self._prompt_cache_name = cache.name
+                except Exception as e:
+                    logger.warning(f"Prompt prefix caching unavailable, sending full prompts: {e}")
+                    self._prompt_cache_name = ''
+            return self._prompt_cache_name or None
+
+    def _discard_prompt_cache(self, cache_name: str) -> None:
+        """Forgets an expired cache, unless another thread already replaced it with a new one"""
+        with self._prompt_cache_lock:
+            if self._prompt_cache_name == cache_name:
+                self._prompt_cache_name = None
+
+    def release_prompt_cache(self) -> None:
+        """Deletes the cached prompt prefix once the upload is done, so its storage is not billed until the TTL ends"""
+        with self._prompt_cache_lock:
+            cache_name, self._prompt_cache_name = self._prompt_cache_name, None
+        if cache_name:
+            try:
+                self.client.caches.delete(name=cache_name)
+            except Exception as e:
+                logger.warning(f"Could not delete the prompt prefix cache {cache_name}: {e}")
+
     def process_batch(self, batch: list[AgentTransactionUpload], upload_file: UploadFile) -> tuple[list[
         TransactionCategorization], GeminiResponse | None]:
         """
@@ -724,13 +970,25 @@ class ExpenseCategorizerAgent:
         Returns:
             list[TransactionCategorization]: Array of categorization objects
         """
+        response = None
         try:
             logger.info(f"Analyzing batch with {len(batch)} transactions...")
-            # Build prompt with CSV column hints
-            prompt = self.build_batch_prompt(batch, upload_file)
+            # Build prompt with CSV column hints: only the variable tail when the static prefix is cached
+            cache_name = self._get_prompt_cache_name()
+            if cache_name:
+                prompt = self._build_batch_prompt_tail(batch, upload_file)
+            else:
+                prompt = self.build_batch_prompt(batch, upload_file)
 
             # Send to API using new SDK
-            response = call_gemini_api(prompt, self.client)
+            try:
+                response = call_gemini_api(prompt, self.client, response_schema=categorization_response_schema,
+                                           stream=self.stream_responses, cached_content=cache_name)
+            except Exception as e:
+                if cache_name and is_prompt_cache_error(e):
+                    # The cache expired: the next attempt creates a new one
+                    self._discard_prompt_cache(cache_name)
+                raise
 
             # Parse JSON array response
             categorizations_data = parse_json_array(response.text)
@@ -749,4 +1007,7 @@ class ExpenseCategorizerAgent:
 
         except Exception as e:
             logger.error(f"Analysis failed: {str(e)}", exc_info=True)
+            if response is not None:
+                # Keep the text the model actually returned, the retry will produce a different one
+                logger.error(f"Unparsable response text: {(response.text or '')[:2000]}")
             raise e
\ No newline at end of file
@@ -0,0 +1,52 @@
+import os
+import unittest
+from decimal import Decimal
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+
+from agent.agent import TransactionCategorization, GeminiResponse
+from api.models import Transaction, UploadFile
+from processors.expense_upload_processor import ExpenseUploadProcessor
+
+
+class TestAgentBatchDeduplication(unittest.TestCase):
+    def setUp(self):
+        with patch.dict(os.environ, {'GEMINI_API_KEY': 'test-key'}):
+            self.processor = ExpenseUploadProcessor(user=User(username='dedup'))
+
+    @staticmethod
+    def _transaction(tx_id: int, description_hash: str | None, amount: str | None) -> Transaction:
+        return Transaction(id=tx_id, description_hash=description_hash,
+                           amount=Decimal(amount) if amount else None, raw_data={'Descrizione': str(tx_id)})
+
+    def test_identical_transactions_are_sent_once(self):
+        batch = [
+            self._transaction(1, 'netflix', '12.99'),
+            self._transaction(2, 'netflix', '12.99'),
+            self._transaction(3, 'netflix', '17.99'),
+            self._transaction(4, None, None),
+            self._transaction(5, None, None),
+        ]
+
+        uploads, duplicate_ids = self.processor._build_agent_batch(batch)
+
+        self.assertEqual([upload.transaction_id for upload in uploads], [1, 3, 4, 5])
+        self.assertEqual(duplicate_ids, {'1': [2]})
+
+    def test_agent_result_is_copied_to_the_duplicates(self):
+        categorization = TransactionCategorization(
+            transaction_id='1', date='2025-10-15', reasoning=None, category='Abbonamenti', merchant='NETFLIX',
+            amount=12.99, original_amount='-12,99', description='NETFLIX')
+        response = GeminiResponse(text='', prompt_tokens=10, candidate_tokens=5, model_name='gemini-2.5-flash-lite')
+        uploads, duplicate_ids = self.processor._build_agent_batch([
+            self._transaction(1, 'netflix', '12.99'),
+            self._transaction(2, 'netflix', '12.99'),
+        ])
+
+        with patch.object(self.processor.agent, 'process_batch', return_value=([categorization], response)) as mock_batch:
+            categorizations, _ = self.processor._process_with_agent(uploads, duplicate_ids, UploadFile())
+
+        self.assertEqual(len(mock_batch.call_args.kwargs['batch']), 1)
+        self.assertEqual([(c.transaction_id, c.category, c.merchant) for c in categorizations],
+                         [('1', 'Abbonamenti', 'NETFLIX'), ('2', 'Abbonamenti', 'NETFLIX')])
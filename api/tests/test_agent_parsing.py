@@ -0,0 +1,199 @@
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch, MagicMock
+
+from google.genai import errors
+
+from agent.agent import (
+    parse_json_array, ExpenseCategorizerAgent, AgentTransactionUpload, GeminiResponse, categorization_response_schema,
+    call_gemini_api, parse_llm_response_json, csv_structure_response_schema, is_retryable_gemini_error,
+    RequestRateLimiter, gemini_retry_delay
+)
+from api.models import UploadFile
+
+
+class TestParseJsonArray(unittest.TestCase):
+    def test_fenced_array_with_trailing_text(self):
+        text = '```json\n[{"transaction_id": 1, "category": "Shopping"}]\n```\nFine.'
+
+        self.assertEqual(parse_json_array(text), [{"transaction_id": 1, "category": "Shopping"}])
+
+    def test_brackets_inside_strings_do_not_end_the_array(self):
+        text = '[{"transaction_id": 1, "reasoning": "contiene ] e [ nel testo"}] extra ]'
+
+        self.assertEqual(parse_json_array(text), [{"transaction_id": 1, "reasoning": "contiene ] e [ nel testo"}])
+
+    def test_truncated_array_is_reported(self):
+        with self.assertRaisesRegex(ValueError, "truncated"):
+            parse_json_array('[{"transaction_id": 1, "category": "Sho')
+
+    def test_invalid_json_is_reported(self):
+        with self.assertRaisesRegex(ValueError, "Invalid JSON response"):
+            parse_json_array('[{"transaction_id": 1,, }]')
+
+    def test_bare_json_mode_array(self):
+        self.assertEqual(parse_json_array('[{"transaction_id": "3", "amount": 1.5, "failure": false}]'),
+                         [{"transaction_id": "3", "amount": 1.5, "failure": False}])
+
+    def test_bare_fences_are_stripped(self):
+        self.assertEqual(parse_json_array('  ```\n[{"transaction_id": 2}]\n```  '), [{"transaction_id": 2}])
+
+
+class TestParseLlmResponseJson(unittest.TestCase):
+    def test_fenced_object_is_parsed(self):
+        text = 'Ecco:\n```json\n{"description_field": "Descrizione", "confidence": "high", "notes": "città"}\n```'
+
+        self.assertEqual(parse_llm_response_json(text),
+                         {"description_field": "Descrizione", "confidence": "high", "notes": "città"})
+
+    def test_bare_object_is_parsed_without_fences(self):
+        self.assertEqual(parse_llm_response_json(' {"merchant_field": null, "confidence": "medium"}\n'),
+                         {"merchant_field": None, "confidence": "medium"})
+
+    def test_object_after_prose_without_fences_is_parsed(self):
+        self.assertEqual(parse_llm_response_json('Ecco il risultato: {"confidence": "low", "notes": "a } b"} fine'),
+                         {"confidence": "low", "notes": "a } b"})
+
+    def test_malformed_object_gives_an_empty_dict(self):
+        with self.assertLogs('agent.agent', level='ERROR'):
+            self.assertEqual(parse_llm_response_json('```json\n{"confidence": }\n```'), {})
+
+
+class TestProcessBatchFailure(unittest.TestCase):
+    @patch('agent.agent.call_gemini_api')
+    def test_unparsable_response_is_logged_without_calling_the_api_again(self, mock_call):
+        mock_call.return_value = GeminiResponse(text="Mi dispiace, non posso", prompt_tokens=10, candidate_tokens=5,
+                                                model_name="gemini-2.5-flash-lite")
+        agent = ExpenseCategorizerAgent(api_key="test-key")
+        batch = [AgentTransactionUpload(transaction_id=1, raw_text={"Descrizione": "AMAZON"})]
+
+        with self.assertLogs('agent.agent', level='ERROR') as logs, self.assertRaises(ValueError):
+            agent.process_batch(batch, UploadFile())
+
+        self.assertEqual(mock_call.call_count, 1)
+        self.assertTrue(any("Mi dispiace, non posso" in line for line in logs.output))
+
+
+class TestProcessBatchJsonMode(unittest.TestCase):
+    @patch('agent.agent.call_gemini_api')
+    def test_batch_is_requested_in_json_mode_and_raw_body_is_parsed(self, mock_call):
+        mock_call.return_value = GeminiResponse(
+            text='[{"transaction_id": "1", "date": "2025-10-15", "category": "Shopping", "merchant": "AMAZON", '
+                 '"amount": 10.0, "original_amount": "-10,00", "description": "AMAZON", "reasoning": "acquisto online", '
+                 '"applied_user_rule": null, "failure": false}]',
+            prompt_tokens=10, candidate_tokens=5, model_name="gemini-2.5-flash-lite")
+        agent = ExpenseCategorizerAgent(api_key="test-key")
+        batch = [AgentTransactionUpload(transaction_id=1, raw_text={"Descrizione": "AMAZON"})]
+
+        categorizations, _ = agent.process_batch(batch, UploadFile())
+
+        self.assertIs(mock_call.call_args.kwargs['response_schema'], categorization_response_schema)
+        self.assertEqual([(c.transaction_id, c.category) for c in categorizations], [("1", "Shopping")])
+
+
+class TestStreamedResponse(unittest.TestCase):
+    def test_streamed_chunks_are_joined_and_usage_taken_from_the_last_chunk(self):
+        client = MagicMock()
+        client.models.generate_content_stream.return_value = iter([
+            SimpleNamespace(text='[{"transaction_id": ', usage_metadata=None),
+            SimpleNamespace(text='"1"}]', usage_metadata=None),
+            SimpleNamespace(text=None, usage_metadata=SimpleNamespace(prompt_token_count=120, candidates_token_count=8)),
+        ])
+
+        response = call_gemini_api("prompt", client, stream=True)
+
+        client.models.generate_content.assert_not_called()
+        self.assertEqual(parse_json_array(response.text), [{"transaction_id": "1"}])
+        self.assertEqual((response.prompt_tokens, response.candidate_tokens), (120, 8))
+
+
+class TestDetectCsvStructureJsonMode(unittest.TestCase):
+    @patch('agent.agent.call_gemini_api')
+    def test_structure_is_requested_in_json_mode_and_bare_body_is_parsed(self, mock_call):
+        mock_call.return_value = GeminiResponse(
+            text='{"description_field": "Descrizione", "merchant_field": null, "transaction_date_field": "Data", '
+                 '"expense_amount_field": "Importo", "income_amount_field": "Importo", "operation_type_field": null, '
+                 '"confidence": "high", "notes": "colonna importo unica"}',
+            prompt_tokens=10, candidate_tokens=5, model_name="gemini-2.5-flash-lite")
+        agent = ExpenseCategorizerAgent(api_key="test-key")
+        samples = [AgentTransactionUpload(transaction_id=1, raw_text={"Data": "15/10/2025", "Importo": "-10,00",
+                                                                      "Descrizione": "AMAZON"})]
+
+        structure, response = agent.detect_csv_structure(samples)
+
+        self.assertIs(mock_call.call_args.kwargs['response_schema'], csv_structure_response_schema)
+        self.assertIsNotNone(response)
+        self.assertEqual((structure.description_field, structure.merchant_field, structure.confidence),
+                         ("Descrizione", None, "high"))
+
+    @patch('agent.agent.call_gemini_api')
+    def test_known_date_column_note_comes_after_the_instructions(self, mock_call):
+        mock_call.return_value = GeminiResponse(text='{"confidence": "low"}', prompt_tokens=1, candidate_tokens=1,
+                                                model_name="gemini-2.5-flash-lite")
+        agent = ExpenseCategorizerAgent(api_key="test-key")
+        samples = [AgentTransactionUpload(transaction_id=1, raw_text={"Data": "15/10/2025"})]
+
+        agent.detect_csv_structure(samples)
+        agent.detect_csv_structure(samples, known_date_column="Data")
+
+        plain_prompt, noted_prompt = (call.kwargs['prompt'] for call in mock_call.call_args_list)
+        shared_prefix = plain_prompt[:plain_prompt.index("CAMPIONI DI TRANSAZIONI")]
+        self.assertTrue(noted_prompt.startswith(shared_prefix))
+        self.assertIn("NOTA: Abbiamo già identificato che il campo della data è 'Data'", noted_prompt[len(shared_prefix):])
+
+
+class TestRetryableGeminiErrors(unittest.TestCase):
+    def _wrapped_api_error(self, error: Exception) -> Exception:
+        client = MagicMock()
+        client.models.generate_content.side_effect = error
+        try:
+            call_gemini_api("prompt", client)
+        except Exception as e:
+            return e
+        self.fail("call_gemini_api did not raise")
+
+    def test_client_errors_are_not_retried(self):
+        for code in (400, 401, 403, 404):
+            error = self._wrapped_api_error(errors.ClientError(code, {'error': {'message': 'no'}}))
+            self.assertFalse(is_retryable_gemini_error(error), code)
+
+    def test_expired_prompt_cache_is_retried(self):
+        error = self._wrapped_api_error(errors.ClientError(404, {'error': {
+            'message': 'CachedContent not found (or permission denied)'}}))
+        self.assertTrue(is_retryable_gemini_error(error))
+
+    def test_rate_limits_server_errors_and_bad_answers_are_retried(self):
+        self.assertTrue(is_retryable_gemini_error(self._wrapped_api_error(errors.ClientError(429, {}))))
+        self.assertTrue(is_retryable_gemini_error(self._wrapped_api_error(errors.ServerError(503, {}))))
+        self.assertTrue(is_retryable_gemini_error(self._wrapped_api_error(ConnectionError("reset"))))
+        self.assertTrue(is_retryable_gemini_error(ValueError("Invalid JSON response")))
+
+    def test_retry_delay_requested_by_a_quota_error_is_read(self):
+        quota_error = errors.ClientError(429, {'error': {'code': 429, 'details': [
+            {'@type': 'type.googleapis.com/google.rpc.QuotaFailure'},
+            {'@type': 'type.googleapis.com/google.rpc.RetryInfo', 'retryDelay': '27s'},
+        ]}})
+        self.assertEqual(gemini_retry_delay(self._wrapped_api_error(quota_error)), 27.0)
+        self.assertIsNone(gemini_retry_delay(self._wrapped_api_error(errors.ServerError(503, {}))))
+        self.assertIsNone(gemini_retry_delay(ValueError("Invalid JSON response")))
+
+
+class TestRequestRateLimiter(unittest.TestCase):
+    @patch('agent.agent.time.sleep')
+    @patch('agent.agent.time.monotonic', return_value=100.0)
+    def test_requests_are_spaced_by_the_quota(self, _mock_monotonic, mock_sleep):
+        limiter = RequestRateLimiter(requests_per_minute=120)
+
+        for _ in range(3):
+            limiter.acquire()
+
+        self.assertEqual([call.args[0] for call in mock_sleep.call_args_list], [0.5, 1.0])
+
+    @patch('agent.agent.time.sleep')
+    def test_zero_quota_never_waits(self, mock_sleep):
+        limiter = RequestRateLimiter(requests_per_minute=0)
+
+        for _ in range(3):
+            limiter.acquire()
+
+        mock_sleep.assert_not_called()
@@ -0,0 +1,167 @@
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch, MagicMock
+
+from google.genai import errors
+
+from agent.agent import (
+    ExpenseCategorizerAgent, AgentTransactionUpload, GeminiResponse, is_retryable_gemini_error
+)
+from api.models import Category, UploadFile
+from processors.utils import retry_with_backoff
+
+
+class TestBatchPrompt(unittest.TestCase):
+    def setUp(self):
+        self.agent = ExpenseCategorizerAgent(
+            api_key="test-key",
+            user_rules=["AMAZON va sempre in Shopping"],
+            available_categories=[Category(name="Shopping", description="acquisti online"), Category(name="Sport")]
+        )
+        self.upload_file = UploadFile(description_column_name="Descrizione", date_column_name="Data",
+                                      expense_amount_column_name="Importo")
+
+    def _batch(self, description: str) -> list[AgentTransactionUpload]:
+        return [AgentTransactionUpload(transaction_id=1, raw_text={"Descrizione": description, "Importo": "-10,00"})]
+
+    def test_static_prefix_is_shared_across_batches(self):
+        first = self.agent.build_batch_prompt(self._batch("AMAZON EU"), self.upload_file)
+        second = self.agent.build_batch_prompt(self._batch("DECATHLON"), self.upload_file)
+
+        self.assertTrue(first.startswith(self.agent._static_prompt_prefix))
+        self.assertTrue(second.startswith(self.agent._static_prompt_prefix))
+        self.assertIn("AMAZON va sempre in Shopping", self.agent._static_prompt_prefix)
+        self.assertIn('"Shopping": acquisti online', self.agent._static_prompt_prefix)
+
+    def test_static_prefix_does_not_depend_on_category_order(self):
+        categories = [Category(name="Sport"), Category(name="Shopping", description="acquisti online")]
+        reversed_agent = ExpenseCategorizerAgent(api_key="test-key", user_rules=["AMAZON va sempre in Shopping"],
+                                                 available_categories=categories)
+
+        self.assertEqual(reversed_agent._static_prompt_prefix, self.agent._static_prompt_prefix)
+
+    def test_batch_data_is_after_the_static_prefix(self):
+        prompt = self.agent.build_batch_prompt(self._batch("AMAZON EU"), self.upload_file)
+        tail = prompt[len(self.agent._static_prompt_prefix):]
+
+        self.assertIn("AMAZON EU", tail)
+        self.assertIn("Il campo 'Descrizione' contiene la descrizione", tail)
+        self.assertNotIn("AMAZON EU", self.agent._static_prompt_prefix)
+
+    def test_raw_data_lines_are_formatted_once_and_truncated(self):
+        batch = self._batch("X" * 250)
+        first = self.agent.build_batch_prompt(batch, self.upload_file)
+        batch[0].raw_text["Descrizione"] = "changed after the first build"
+
+        self.assertEqual(self.agent.build_batch_prompt(batch, self.upload_file), first)
+        self.assertIn(f"   - Descrizione: {'X' * 200}...\n", first)
+
+    def test_csv_hints_are_rendered_once_per_saved_upload(self):
+        self.upload_file.pk = 7
+        with patch.object(ExpenseCategorizerAgent, '_build_csv_hints_section', return_value="HINTS\n") as mock_hints:
+            first = self.agent.build_batch_prompt(self._batch("AMAZON EU"), self.upload_file)
+            second = self.agent.build_batch_prompt(self._batch("DECATHLON"), self.upload_file)
+
+        mock_hints.assert_called_once_with(self.upload_file)
+        self.assertIn("HINTS", first)
+        self.assertIn("HINTS", second)
+
+
+class TestAgentClient(unittest.TestCase):
+    def test_agents_with_the_same_key_share_the_client(self):
+        first = ExpenseCategorizerAgent(api_key="test-key")
+        second = ExpenseCategorizerAgent(api_key="test-key")
+        other = ExpenseCategorizerAgent(api_key="other-key")
+
+        self.assertIs(first.client, second.client)
+        self.assertIsNot(first.client, other.client)
+
+
+@patch.object(ExpenseCategorizerAgent, 'context_cache_enabled', True)
+@patch('agent.agent.call_gemini_api', return_value=GeminiResponse(text="[]", prompt_tokens=1, candidate_tokens=1,
+                                                                  model_name="gemini-2.5-flash-lite"))
+class TestPromptPrefixCache(unittest.TestCase):
+    def setUp(self):
+        self.agent = ExpenseCategorizerAgent(api_key="test-key", available_categories=[Category(name="Sport")])
+        self.agent.client = MagicMock()
+        self.batch = [AgentTransactionUpload(transaction_id=1, raw_text={"Descrizione": "DECATHLON"})]
+
+    def test_cached_prefix_is_created_once_and_only_the_tail_is_sent(self, mock_call):
+        self.agent.client.caches.create.return_value = SimpleNamespace(name="cachedContents/prefix")
+
+        self.agent.process_batch(self.batch, UploadFile())
+        self.agent.process_batch(self.batch, UploadFile())
+
+        self.agent.client.caches.create.assert_called_once()
+        prompt = mock_call.call_args.args[0]
+        self.assertEqual(mock_call.call_args.kwargs['cached_content'], "cachedContents/prefix")
+        self.assertIn("DECATHLON", prompt)
+        self.assertNotIn(self.agent._static_prompt_prefix, prompt)
+
+    def test_full_prompt_is_sent_when_the_cache_cannot_be_created(self, mock_call):
+        self.agent.client.caches.create.side_effect = Exception("too few tokens")
+
+        self.agent.process_batch(self.batch, UploadFile())
+
+        self.assertIsNone(mock_call.call_args.kwargs['cached_content'])
+        self.assertTrue(mock_call.call_args.args[0].startswith(self.agent._static_prompt_prefix))
+
+    def test_cache_is_kept_when_the_request_fails_for_another_reason(self, mock_call):
+        self.agent.client.caches.create.return_value = SimpleNamespace(name="cachedContents/prefix")
+        rate_limited = Exception("API request failed")
+        rate_limited.__cause__ = errors.ClientError(429, {'error': {'message': 'Resource exhausted'}})
+        mock_call.side_effect = [rate_limited, mock_call.return_value]
+
+        with self.assertRaises(Exception):
+            self.agent.process_batch(self.batch, UploadFile())
+        self.agent.process_batch(self.batch, UploadFile())
+
+        self.agent.client.caches.create.assert_called_once()
+
+    def test_expired_cache_is_created_again(self, mock_call):
+        self.agent.client.caches.create.side_effect = [SimpleNamespace(name="cachedContents/expired"),
+                                                       SimpleNamespace(name="cachedContents/renewed")]
+        expired = Exception("API request failed")
+        expired.__cause__ = errors.ClientError(403, {'error': {
+            'code': 403, 'message': 'CachedContent not found (or permission denied)', 'status': 'PERMISSION_DENIED'}})
+        mock_call.side_effect = [expired, mock_call.return_value]
+
+        with self.assertRaises(Exception):
+            self.agent.process_batch(self.batch, UploadFile())
+        self.agent.process_batch(self.batch, UploadFile())
+
+        self.assertEqual(mock_call.call_args.kwargs['cached_content'], "cachedContents/renewed")
+
+    def test_batch_is_retried_with_a_new_cache_when_the_cache_expired(self, mock_call):
+        self.agent.client.caches.create.side_effect = [SimpleNamespace(name="cachedContents/expired"),
+                                                       SimpleNamespace(name="cachedContents/renewed")]
+        expired = Exception("API request failed")
+        expired.__cause__ = errors.ClientError(403, {'error': {
+            'code': 403, 'message': 'CachedContent not found (or permission denied)', 'status': 'PERMISSION_DENIED'}})
+        mock_call.side_effect = [expired, mock_call.return_value]
+
+        with patch('time.sleep'):
+            categorizations, response = retry_with_backoff(
+                self.agent.process_batch, max_retries=3, base_delay=0.01, on_failure=([], None),
+                retry_on=is_retryable_gemini_error, batch=self.batch, upload_file=UploadFile()
+            )
+
+        self.assertIsNotNone(response)
+        self.assertEqual(mock_call.call_count, 2)
+        self.assertEqual(mock_call.call_args.kwargs['cached_content'], "cachedContents/renewed")
+
+    def test_late_failure_does_not_discard_a_renewed_cache(self, mock_call):
+        self.agent._prompt_cache_name = "cachedContents/renewed"
+
+        self.agent._discard_prompt_cache("cachedContents/expired")
+
+        self.assertEqual(self.agent._prompt_cache_name, "cachedContents/renewed")
+
+    def test_released_cache_is_deleted(self, mock_call):
+        self.agent.client.caches.create.return_value = SimpleNamespace(name="cachedContents/prefix")
+        self.agent.process_batch(self.batch, UploadFile())
+
+        self.agent.release_prompt_cache()
+        self.agent.release_prompt_cache()
+
+        self.agent.client.caches.delete.assert_called_once_with(name="cachedContents/prefix")
@@ -0,0 +1,55 @@
+import os
+import unittest
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+
+from processors.batching_helper import BatchingHelper
+from processors.expense_upload_processor import ExpenseUploadProcessor
+
+
+class TestPackBatches(unittest.TestCase):
+    def setUp(self):
+        self.helper = BatchingHelper(batch_size=4)
+        self.helper.batch_input_token_budget = 100
+        self.helper.batch_output_token_budget = 1000
+        self.helper.output_tokens_per_item = 100
+
+    def test_batches_are_capped_by_batch_size(self):
+        batches = list(self.helper.pack_batches(range(10), lambda _: 1))
+
+        self.assertEqual(batches, [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]])
+
+    def test_batches_are_closed_before_exceeding_the_input_budget(self):
+        batches = list(self.helper.pack_batches([40, 40, 40, 150, 10], lambda tokens: tokens))
+
+        self.assertEqual(batches, [[40, 40], [40], [150], [10]])
+
+    def test_batches_are_closed_before_exceeding_the_output_budget(self):
+        self.helper.batch_output_token_budget = 250
+
+        batches = list(self.helper.pack_batches(range(5), lambda _: 1))
+
+        self.assertEqual(batches, [[0, 1], [2, 3], [4]])
+
+    def test_items_are_consumed_lazily(self):
+        consumed = []
+
+        def items():
+            for i in range(10):
+                consumed.append(i)
+                yield i
+
+        first_batch = next(self.helper.pack_batches(items(), lambda _: 1))
+
+        self.assertEqual(first_batch, [0, 1, 2, 3])
+        self.assertEqual(consumed, [0, 1, 2, 3, 4])
+
+
+class TestAgentBatchSize(unittest.TestCase):
+    def test_only_the_agent_batches_use_the_agent_batch_size(self):
+        with patch.dict(os.environ, {'GEMINI_API_KEY': 'test-key'}):
+            processor = ExpenseUploadProcessor(user=User(username='batching'))
+
+        self.assertEqual(processor.batch_helper.batch_size, ExpenseUploadProcessor.agent_batch_size)
+        self.assertEqual(BatchingHelper().batch_size, BatchingHelper.batch_size)
@@ -0,0 +1,94 @@
+import io
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+
+from processors.file_parsers import (
+    _clean_dataframe_to_dict, _find_header_row, FileParserError, parse_uploaded_file, _sniff_csv_separator
+)
+
+
+class TestCleanDataframeToDict(unittest.TestCase):
+    def test_cells_are_stripped_strings_and_missing_values_are_none(self):
+        df = pd.DataFrame({
+            'Data': ['01/02/2024', ' 02/02/2024 '],
+            'Importo': [-12.5, np.nan],
+            'Descrizione': ['  AMAZON ', 'nan'],
+        })
+
+        records = _clean_dataframe_to_dict(df)
+
+        self.assertEqual(records, [
+            {'Data': '01/02/2024', 'Importo': '-12.5', 'Descrizione': 'AMAZON'},
+            {'Data': '02/02/2024', 'Importo': None, 'Descrizione': None},
+        ])
+
+    def test_datetime_columns_are_formatted_day_first(self):
+        df = pd.DataFrame({'Data': pd.to_datetime(['2024-01-31', None])})
+
+        records = _clean_dataframe_to_dict(df)
+
+        self.assertEqual(records, [{'Data': '31/01/2024'}])
+
+    def test_rows_left_empty_are_dropped(self):
+        df = pd.DataFrame({'a': [None, 'x'], 'b': ['NULL', ' ']})
+
+        records = _clean_dataframe_to_dict(df)
+
+        self.assertEqual(records, [{'a': 'x', 'b': None}])
+
+
+@patch('processors.file_parsers.FileStructureMetadata.objects.filter', return_value=[])
+class TestFindHeaderRowHeuristic(unittest.TestCase):
+    def test_row_with_most_bank_keywords_is_the_header(self, _):
+        df_preview = pd.DataFrame([
+            ['Estratto conto', None, None],
+            ['Data contabile', 'Descrizione', 'Importo'],
+            ['01/02/2024', 'AMAZON', '-10,00'],
+        ])
+
+        self.assertEqual(_find_header_row(df_preview), (1, None))
+
+    def test_single_keyword_is_not_enough(self, _):
+        df_preview = pd.DataFrame([['Data', 'Causale'], ['01/02/2024', 'AMAZON']])
+
+        with self.assertRaises(FileParserError):
+            _find_header_row(df_preview)
+
+
+class TestFindHeaderRowMetadata(unittest.TestCase):
+    def test_row_containing_all_metadata_columns_is_the_header(self):
+        metadata = SimpleNamespace(date_column_name='Data', description_column_name='Causale',
+                                   expense_amount_column_name='Uscite', income_amount_column_name=None)
+        df_preview = pd.DataFrame([
+            ['Conto', 12345, None],
+            [' Data ', 'Causale', 'Uscite'],
+            ['01/02/2024', 'AMAZON', -10.0],
+        ])
+
+        with patch('processors.file_parsers.FileStructureMetadata.objects.filter', return_value=[metadata]):
+            self.assertEqual(_find_header_row(df_preview), (1, metadata))
+
+
+@patch('processors.file_parsers.FileStructureMetadata.objects.filter', return_value=[])
+class TestParseUploadedCsv(unittest.TestCase):
+    def _csv(self, text: str) -> io.BytesIO:
+        file = io.BytesIO(text.encode('utf-8'))
+        file.name = 'estratto.csv'
+        return file
+
+    def test_preamble_quoted_separator_and_footer(self, _):
+        file = self._csv('Estratto conto;;\n\nData contabile;Descrizione;Importo\n'
+                         '01/02/2024;"AMAZON; EU";-10,00\n02/02/2024;ESSELUNGA;-5,50\nTotale;;-15,50\n')
+
+        self.assertEqual(parse_uploaded_file(file), [
+            {'Data contabile': '01/02/2024', 'Descrizione': 'AMAZON; EU', 'Importo': '-10,00'},
+            {'Data contabile': '02/02/2024', 'Descrizione': 'ESSELUNGA', 'Importo': '-5,50'},
+        ])
+
+    def test_separator_is_sniffed_from_the_first_line(self, _):
+        self.assertEqual(_sniff_csv_separator('\nData,Descrizione,Importo\n01/02/2024,AMAZON,"-10,00"\n'), ',')
+        self.assertEqual(_sniff_csv_separator('Estratto\n'), ';')
@@ -0,0 +1,40 @@
+import os
+import unittest
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+
+from api.models import Rule, Merchant, Category
+from processors.expense_upload_processor import ExpenseUploadProcessor
+
+
+class TestLocalRules(unittest.TestCase):
+    def setUp(self):
+        with patch.dict(os.environ, {'GEMINI_API_KEY': 'test-key'}):
+            self.processor = ExpenseUploadProcessor(user=User(username='rules'))
+        self.fuel_rule = Rule(merchant=Merchant(name='RETITALIA'), category=Category(name='Carburante'))
+        self.processor._set_local_rules([self.fuel_rule])
+
+    def test_rule_merchant_in_the_description_decides_the_category(self):
+        self.assertIs(self.processor._match_local_rule("Pagamento POS RetItalia Milano 12/03"), self.fuel_rule)
+
+    def test_rule_merchant_inside_another_word_does_not_match(self):
+        self.assertIsNone(self.processor._match_local_rule("Pagamento POS SUPERRETITALIANA"))
+
+    def test_most_recent_rule_of_a_merchant_and_longest_name_win(self):
+        newer_fuel_rule = Rule(merchant=Merchant(name='RetItalia'), category=Category(name='Auto'))
+        prime_rule = Rule(merchant=Merchant(name='Amazon Prime'), category=Category(name='Abbonamenti'))
+        amazon_rule = Rule(merchant=Merchant(name='Amazon'), category=Category(name='Shopping'))
+        self.processor._set_local_rules([newer_fuel_rule, self.fuel_rule, amazon_rule, prime_rule])
+
+        self.assertIs(self.processor._match_local_rule("RETITALIA 12/03"), newer_fuel_rule)
+        self.assertIs(self.processor._match_local_rule("Addebito AMAZON PRIME mensile"), prime_rule)
+        self.assertIs(self.processor._match_local_rule("Addebito AMAZON EU"), amazon_rule)
+
+    def test_short_rule_merchant_is_only_trusted_near_the_start(self):
+        phone_rule = Rule(merchant=Merchant(name='TIM'), category=Category(name='Telefonia'))
+        self.processor._set_local_rules([phone_rule, self.fuel_rule])
+
+        self.assertIs(self.processor._match_local_rule("TIM ricarica 12/03"), phone_rule)
+        self.assertIsNone(self.processor._match_local_rule("Bonifico a favore di Mario Rossi causale TIM"))
+        self.assertIs(self.processor._match_local_rule("Addebito carta 12/03 TIM RETITALIA"), self.fuel_rule)
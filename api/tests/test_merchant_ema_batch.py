@@ -0,0 +1,33 @@
+import pytest
+import numpy as np
+from django.contrib.auth.models import User
+from api.models import Merchant, MerchantEMA, FileStructureMetadata
+from processors.similarity_matcher import update_merchant_ema, update_merchant_emas
+
+
+@pytest.mark.django_db
+def test_update_merchant_emas_matches_sequential_updates() -> None:
+    """
+    Tests that the batched EMA update writes the same footprints as repeated update_merchant_ema calls.
+    """
+    user = User.objects.create_user(username='testuser_ema_batch', password='password')
+    existing_merchant = Merchant.objects.create(name='Esselunga', user=user)
+    new_merchant = Merchant.objects.create(name='Decathlon', user=user)
+    fs_batch = FileStructureMetadata.objects.create(row_hash='test_ema_batch_hash')
+    fs_sequential = FileStructureMetadata.objects.create(row_hash='test_ema_sequential_hash')
+
+    start = [0.5] * 384
+    embeddings = [[0.1] * 384, [0.9] * 384, [0.3] * 384]
+    for fs in (fs_batch, fs_sequential):
+        MerchantEMA.objects.create(merchant=existing_merchant, file_structure_metadata=fs, digital_footprint=start)
+
+    update_merchant_emas([(merchant, fs_batch, embedding)
+                          for merchant in (existing_merchant, new_merchant) for embedding in embeddings])
+    for merchant in (existing_merchant, new_merchant):
+        for embedding in embeddings:
+            update_merchant_ema(merchant, fs_sequential, embedding)
+
+    for merchant in (existing_merchant, new_merchant):
+        batch_ema = MerchantEMA.objects.get(merchant=merchant, file_structure_metadata=fs_batch)
+        sequential_ema = MerchantEMA.objects.get(merchant=merchant, file_structure_metadata=fs_sequential)
+        assert np.allclose(batch_ema.digital_footprint, sequential_ema.digital_footprint)
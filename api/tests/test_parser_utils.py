@@ -0,0 +1,38 @@
+import unittest
+from datetime import date
+from decimal import Decimal
+
+from processors.parser_utils import _split_by_separators, separators, parse_raw_date, _try_parse_date, normalize_amount
+
+
+class TestSplitBySeparators(unittest.TestCase):
+    def test_splits_on_every_separator(self):
+        words = [w for w in _split_by_separators("15/10/2025 ore;12:00,valuta\t16/10/2025|x\ny", separators) if w]
+
+        self.assertEqual(words, ['15/10/2025', 'ore', '12:00', 'valuta', '16/10/2025', 'x', 'y'])
+
+    def test_date_is_found_among_other_words(self):
+        self.assertEqual(parse_raw_date("Contabile | 15/10/2025  ore 12"), date(2025, 10, 15))
+
+
+class TestTryParseDate(unittest.TestCase):
+    def test_repeated_words_are_parsed_once(self):
+        _try_parse_date.cache_clear()
+
+        self.assertEqual(_try_parse_date('15/10/2025'), date(2025, 10, 15))
+        self.assertEqual(_try_parse_date('15/10/2025'), date(2025, 10, 15))
+        self.assertIsNone(_try_parse_date('ore'))
+
+        self.assertEqual(_try_parse_date.cache_info().hits, 1)
+
+
+class TestNormalizeAmount(unittest.TestCase):
+    def test_italian_and_international_formats(self):
+        self.assertEqual(normalize_amount('-1.234,56 €'), Decimal('-1234.56'))
+        self.assertEqual(normalize_amount('$ 1,234.56'), Decimal('1234.56'))
+        self.assertEqual(normalize_amount('4,42'), Decimal('4.42'))
+        self.assertEqual(normalize_amount('3000'), Decimal('3000'))
+
+    def test_placeholders_are_none(self):
+        self.assertIsNone(normalize_amount(' € '))
+        self.assertIsNone(normalize_amount('nan'))
@@ -0,0 +1,30 @@
+import os
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+
+from processors.expense_upload_processor import ExpenseUploadProcessor
+
+
+@patch.dict(os.environ, {'GEMINI_API_KEY': 'test-key'})
+class TestRagShortNames(unittest.TestCase):
+    def _validate(self, description: str, merchant_name: str, distance: float):
+        processor = ExpenseUploadProcessor(user=User(username='rag'))
+        candidate = SimpleNamespace(merchant=SimpleNamespace(name=merchant_name), distance=distance)
+        tx = SimpleNamespace(embedding=[0.1])
+        with patch.object(ExpenseUploadProcessor, 'find_rag_context', return_value=[candidate]):
+            return processor._is_rag_context_valid(tx, description)
+
+    def test_short_name_at_the_start_is_trusted(self):
+        self.assertIsNotNone(self._validate("TIM ricarica mensile", "TIM", distance=0.2))
+
+    def test_short_name_far_in_the_description_needs_a_near_identical_vector(self):
+        description = "Pagamento POS negozio via tim 12"
+
+        self.assertIsNone(self._validate(description, "TIM", distance=0.2))
+        self.assertIsNotNone(self._validate(description, "TIM", distance=0.01))
+
+    def test_long_name_is_trusted_anywhere(self):
+        self.assertIsNotNone(self._validate("Pagamento Mastercard presso DECATHLON ITALIA", "DECATHLON", distance=0.2))
@@ -53,3 +53,31 @@ class TestUtils(unittest.TestCase):
                 with self.assertRaises(Exception):
                     retry_with_backoff(func)
         self.assertEqual(func.call_count, 2)
+
+    def test_retry_with_backoff_stops_when_retry_on_rejects_the_error(self):
+        func = MagicMock(side_effect=ValueError("permanent"))
+        func.__name__ = "test_func"
+        with patch('time.sleep') as mock_sleep:
+            result = retry_with_backoff(func, max_retries=3, base_delay=0.01, on_failure="failed_value",
+                                        retry_on=lambda e: not isinstance(e, ValueError))
+        self.assertEqual(result, "failed_value")
+        self.assertEqual(func.call_count, 1)
+        mock_sleep.assert_not_called()
+
+    def test_retry_with_backoff_waits_at_least_the_requested_delay(self):
+        func = MagicMock(side_effect=[ValueError("quota"), "success"])
+        func.__name__ = "test_func"
+        with patch('time.sleep') as mock_sleep:
+            result = retry_with_backoff(func, max_retries=3, base_delay=0.01, retry_delay=lambda e: 30.0)
+        self.assertEqual(result, "success")
+        mock_sleep.assert_called_once_with(30.0)
+
+    def test_retry_with_backoff_fails_fast_when_the_requested_delay_is_too_long(self):
+        func = MagicMock(side_effect=ValueError("quota"))
+        func.__name__ = "test_func"
+        with patch('time.sleep') as mock_sleep:
+            result = retry_with_backoff(func, max_retries=3, base_delay=0.01, on_failure="failed_value",
+                                        retry_delay=lambda e: 3600.0, max_retry_delay=60)
+        self.assertEqual(result, "failed_value")
+        self.assertEqual(func.call_count, 1)
+        mock_sleep.assert_not_called()
@@ -1,4 +1,5 @@
 import datetime
+from collections import defaultdict
 from decimal import Decimal
 import pandas as pd
 from django.db.models import Q
@@ -34,17 +35,17 @@ class CategoryExportView(CategoryEnrichedMixin, View):
         if filters['months']:
             tx_filter &= Q(transaction_date__month__in=filters['months'])
             
-        transactions = Transaction.objects.filter(tx_filter).select_related('category')
+        # Amounts are encrypted in the database: they can only be summed here, after decryption.
+        # Only the three columns needed are loaded (no raw_data or embedding).
+        transactions = Transaction.objects.filter(tx_filter).values_list('category_id', 'transaction_date', 'amount')
 
         # 3. Group by category and month
-        from collections import defaultdict
         grouped = defaultdict(lambda: {'count': 0, 'sum': Decimal('0')})
-        
-        for tx in transactions:
-            month = tx.transaction_date.month
-            key = (tx.category_id, month)
+
+        for category_id, transaction_date, amount in transactions.iterator():
+            key = (category_id, transaction_date.month)
             grouped[key]['count'] += 1
-            grouped[key]['sum'] += (tx.amount or Decimal('0'))
+            grouped[key]['sum'] += (amount or Decimal('0'))
 
         ITALIAN_MONTHS = {
             1: 'Gennaio', 2: 'Febbraio', 3: 'Marzo', 4: 'Aprile',
@@ -1,8 +1,18 @@
 import os
-from typing import Any
+from typing import Any, Callable, Iterable, Iterator
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate for prompt budgeting (~4 characters per token)"""
+    return len(text) // 4 + 1
+
 
 class BatchingHelper:
     batch_size = int(os.environ.get('AGENT_BATCH_SIZE', 30))
+    # Per-request budgets for the variable part of the prompt (the static prefix is shared) and for the answer
+    batch_input_token_budget = int(os.environ.get('AGENT_BATCH_INPUT_TOKEN_BUDGET', 12000))
+    batch_output_token_budget = int(os.environ.get('AGENT_BATCH_OUTPUT_TOKEN_BUDGET', 8000))
+    output_tokens_per_item = int(os.environ.get('AGENT_OUTPUT_TOKENS_PER_ITEM', 150))
 
     def __init__(self, batch_size: int = batch_size) -> None:
         self.batch_size = batch_size
@@ -43,3 +53,27 @@ class BatchingHelper:
             batches.append(batch)
 
         return batches
+
+    def pack_batches[T](self, items: Iterable[T], input_tokens: Callable[[T], int]) -> Iterator[list[T]]:
+        """
+        Greedily pack items into batches, consuming the iterable lazily.
+        A batch is closed when the next item would exceed the input or output token budget,
+        or when it already holds batch_size items. An item larger than the budget gets a batch of its own.
+        """
+        batch: list[T] = []
+        batch_input_tokens = 0
+        for item in items:
+            item_input_tokens = input_tokens(item)
+            if batch and (
+                    len(batch) >= self.batch_size
+                    or batch_input_tokens + item_input_tokens > self.batch_input_token_budget
+                    or (len(batch) + 1) * self.output_tokens_per_item > self.batch_output_token_budget
+            ):
+                yield batch
+                batch = []
+                batch_input_tokens = 0
+            batch.append(item)
+            batch_input_tokens += item_input_tokens
+
+        if batch:
+            yield batch
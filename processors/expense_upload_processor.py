@@ -2,24 +2,30 @@ import itertools
 import logging
 import os
 import re
-from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from dataclasses import replace
+from concurrent.futures import ThreadPoolExecutor, Future
 from typing import Iterable
 
 from django.contrib.auth.models import User
 from django.core.files.uploadedfile import UploadedFile
 from django.db import transaction
+from django.db.models import F
 
-from agent.agent import ExpenseCategorizerAgent, AgentTransactionUpload, TransactionCategorization, GeminiResponse
-from api.models import Transaction, Category, Merchant, UploadFile, MerchantEMA
+from agent.agent import (
+    ExpenseCategorizerAgent, AgentTransactionUpload, TransactionCategorization, GeminiResponse,
+    is_retryable_gemini_error, gemini_retry_delay
+)
+from api.models import Transaction, Category, Merchant, UploadFile, MerchantEMA, FileStructureMetadata, Rule
 from api.privacy_utils import generate_blind_index
 from costs.services import CostService
-from processors.batching_helper import BatchingHelper
+from processors.batching_helper import BatchingHelper, estimate_tokens
 from processors.data_prechecks import parse_raw_transaction
 from processors.embeddings import EmbeddingEngine
 from processors.parser_utils import normalize_amount, parse_raw_date
 from processors.similarity_matcher import (
     SimilarityMatcher, generate_embedding, SimilarityMatcherRAG,
-    update_merchant_ema
+    update_merchant_emas
 )
 from processors.transaction_updater import TransactionUpdater
 from processors.utils import retry_with_backoff
@@ -40,6 +46,11 @@ class ExpenseUploadProcessor(SimilarityMatcherRAG):
     pre_check_iterator_fetch_size = int(os.environ.get('PRE_CHECK_ITERATOR_FETCH_SIZE', '50'))
     gemini_max_retries = int(os.environ.get('GEMINI_MAX_RETRIES', '5'))
     gemini_base_delay = int(os.environ.get('GEMINI_BASE_DELAY', '2'))
+    gemini_max_retry_delay = float(os.environ.get('GEMINI_MAX_RETRY_DELAY', '60'))
+    agent_max_workers = int(os.environ.get('AGENT_MAX_WORKERS', '8'))
+    agent_rag_example_tokens = int(os.environ.get('AGENT_RAG_EXAMPLE_TOKENS', '40'))
+    # Upper bound of the token-packed agent batches (see BatchingHelper.pack_batches)
+    agent_batch_size = int(os.environ.get('AGENT_BATCH_SIZE', '50'))
 
     # RAG specific weights and thresholds
     rag_length_bonus_multiplier = float(os.environ.get('RAG_LENGTH_BONUS_MULTIPLIER', '0.015'))
@@ -53,9 +64,14 @@ class ExpenseUploadProcessor(SimilarityMatcherRAG):
 
     def __init__(self, user: User, user_rules: list[str] = None, available_categories: list[Category] | None = None, batch_helper:BatchingHelper | None = None) -> None:
         self.user = user
-        self.batch_helper = batch_helper or BatchingHelper()
+        self.batch_helper = batch_helper or BatchingHelper(batch_size=self.agent_batch_size)
         self.agent = ExpenseCategorizerAgent(user_rules=user_rules, available_categories=available_categories)
         self.similarity_matcher = SimilarityMatcher(user)
+        # Compiled word-boundary patterns by lowercased merchant name, reused across the transactions of this upload
+        self._merchant_name_patterns: dict[str, re.Pattern] = {}
+        # Active rules with a merchant and a category, applied locally before RAG and agent (see _load_local_rules)
+        self._local_rule_by_merchant_name: dict[str, Rule] = {}
+        self._local_rule_pattern: re.Pattern | None = None
 
     def process_transactions(self, transactions: Iterable[Transaction], upload_file: UploadFile) -> UploadFile:
 
@@ -63,6 +79,7 @@ class ExpenseUploadProcessor(SimilarityMatcherRAG):
         transactions_iter = iter(transactions)
 
         logger.info(f"🚀 Starting CSV Processing for: {upload_file.file_name}")
+        self._load_local_rules()
 
         # 2. Process pre-checks and batch for agent using generators to save memory
         def get_transactions_to_upload() -> Iterable[Transaction]:
@@ -73,36 +90,28 @@ class ExpenseUploadProcessor(SimilarityMatcherRAG):
                 yield from self._process_prechecks(chunk, upload_file)
 
         def get_agent_batches() -> Iterable[list[Transaction]]:
-            to_upload_iter = get_transactions_to_upload()
-            while True:
-                # It keeps asking for slices untile it stops at batch_helper_size
-                batch = list(itertools.islice(to_upload_iter, self.batch_helper.batch_size))
-                if not batch:
-                    break
-                yield batch
-
-        with ThreadPoolExecutor() as executor:
-            # Parallelize the agent calls only
-            # 1) Thread executor asks for agent batch
-            # 2) agent batch asks for transaction to upload
-            # 3) transaction to upload are fetched in batch from the database and preprocessed
-            # Thread executor does not wait the first get_agent_batch to complete, but it keeps asking the get_agent_batch as soon as there is a free thread in the loop and there is an actual batch
-            results = executor.map(lambda batch: self._process_with_agent(batch, upload_file), get_agent_batches())
-
-            # Process each batch's results synchronously as they come
-            for batch_result, response in results:
-                if response:
-                    CostService.log_api_usage(
-                        user=self.user,
-                        llm_model=response.model_name,
-                        input_tokens=response.prompt_tokens,
-                        output_tokens=response.candidate_tokens,
-                        number_of_transactions = len(batch_result),
-                        upload_file=upload_file
-                    )
-                if batch_result:
-                    with transaction.atomic():
-                        self._persist_batch_results(batch_result, upload_file)
+            # Batches are packed by estimated prompt/answer tokens (at most batch_helper.batch_size transactions)
+            yield from self.batch_helper.pack_batches(get_transactions_to_upload(), self._estimate_agent_input_tokens)
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.agent_max_workers) as executor:
+                # Parallelize the agent calls only, keeping at most agent_max_workers batches in flight.
+                # 1) The main thread asks for the next agent batch
+                # 2) agent batch asks for transaction to upload
+                # 3) transaction to upload are fetched in batch from the database and preprocessed
+                # executor.map would drain get_agent_batches() eagerly, so we submit lazily instead: pre-checks of the next
+                # batch overlap with the in-flight agent calls, and results are persisted in submission order.
+                # The agent payload is built here, so the worker threads never open database connections of their own.
+                in_flight: deque[Future] = deque()
+                for batch in get_agent_batches():
+                    in_flight.append(executor.submit(self._process_with_agent, *self._build_agent_batch(batch), upload_file))
+                    if len(in_flight) >= self.agent_max_workers:
+                        self._persist_agent_result(*in_flight.popleft().result(), upload_file)
+
+                while in_flight:
+                    self._persist_agent_result(*in_flight.popleft().result(), upload_file)
+        finally:
+            self.agent.release_prompt_cache()
 
         with transaction.atomic():
             self._post_process_transactions(upload_file)
@@ -111,6 +120,64 @@ class ExpenseUploadProcessor(SimilarityMatcherRAG):
 
         return upload_file
 
+    def _load_local_rules(self) -> None:
+        """Loads the user's rules that name both a merchant and a category: they are decided without the agent"""
+        self._set_local_rules(Rule.objects.filter(
+            user=self.user, is_active=True, merchant__isnull=False, category__isnull=False
+        ).select_related('merchant', 'category'))
+
+    def _set_local_rules(self, rules: Iterable[Rule]) -> None:
+        """Indexes the rules by merchant name and compiles one word-boundary alternation over all the names"""
+        self._local_rule_by_merchant_name = {}
+        for rule in rules:
+            # Rules come newest first: the most recent rule of a merchant wins
+            self._local_rule_by_merchant_name.setdefault(rule.merchant.name.lower(), rule)
+        self._local_rule_pattern = None
+        if self._local_rule_by_merchant_name:
+            # Longest names first, so 'amazon prime' is preferred to 'amazon' at the same position
+            merchant_names = sorted(self._local_rule_by_merchant_name, key=len, reverse=True)
+            self._local_rule_pattern = re.compile(rf"\b(?:{'|'.join(map(re.escape, merchant_names))})\b")
+
+    def _match_local_rule(self, description: str) -> Rule | None:
+        """Returns the rule of the first merchant name that appears as a word in the description"""
+        if self._local_rule_pattern is None:
+            return None
+        for match in self._local_rule_pattern.finditer(description.lower()):
+            # Short names (e.g. 'TIM') occur by chance inside long descriptions, as in the RAG validation:
+            # far from the start they are left to the agent instead of deciding the category here
+            if len(match.group()) <= self.rag_short_name_threshold and match.start() > self.rag_short_name_position_threshold:
+                continue
+            return self._local_rule_by_merchant_name[match.group()]
+        return None
+
+    def _get_merchant_name_pattern(self, merchant_name: str) -> re.Pattern:
+        merchant_name_pattern = self._merchant_name_patterns.get(merchant_name)
+        if merchant_name_pattern is None:
+            merchant_name_pattern = re.compile(rf"\b{re.escape(merchant_name)}\b")
+            self._merchant_name_patterns[merchant_name] = merchant_name_pattern
+        return merchant_name_pattern
+
+    def _estimate_agent_input_tokens(self, tx: Transaction) -> int:
+        """Approximate prompt tokens of a transaction: its raw row lines plus one line per RAG example"""
+        raw_data = tx.raw_data or {}
+        raw_data_tokens = estimate_tokens(''.join(f"   - {column}: {value}\n" for column, value in raw_data.items()))
+        return raw_data_tokens + self.agent_rag_example_tokens * len(getattr(tx, 'rag_context', None) or [])
+
+    def _persist_agent_result(self, batch_result: list[TransactionCategorization], response: GeminiResponse | None,
+                              upload_file: UploadFile) -> None:
+        if response:
+            CostService.log_api_usage(
+                user=self.user,
+                llm_model=response.model_name,
+                input_tokens=response.prompt_tokens,
+                output_tokens=response.candidate_tokens,
+                number_of_transactions = len(batch_result),
+                upload_file=upload_file
+            )
+        if batch_result:
+            with transaction.atomic():
+                self._persist_batch_results(batch_result, upload_file)
+
     def _process_prechecks(self, batch: list[Transaction], upload_file: UploadFile) -> list[Transaction]:
         all_transactions_to_upload: list[Transaction] = []
         all_transactions_as_income: list[Transaction] = []
@@ -122,6 +189,10 @@ class ExpenseUploadProcessor(SimilarityMatcherRAG):
         merchant_names_to_fetch = set()
         descriptions_to_embed = set()
         merchant_with_category = dict()
+        # EMA updates of the chunk, written together once the waterfall is done
+        ema_updates: list[tuple[Merchant, FileStructureMetadata, list[float]]] = []
+        # RAG outcome (context, validated reference) by description: repeated descriptions share one vector lookup
+        rag_result_by_description: dict[str, tuple[list[MerchantEMA], MerchantEMA | None]] = dict()
 
         for tx in batch:
             res = parse_raw_transaction(tx.raw_data, [upload_file])
@@ -153,7 +224,35 @@ class ExpenseUploadProcessor(SimilarityMatcherRAG):
             for desc, emb in zip(desc_list, embeddings_gen):
                 embedding_dict[desc] = emb.tolist()
 
-        # 4. Processing Waterfall
+        # 4. Batch duplicate check on the transactions already categorized with the same descriptions.
+        # The same (description_hash, date) pair is a duplicate; the same description on another date is an exact
+        # match, whose latest category and merchant are reused without asking the agent.
+        expense_results = [res for _, res in parsed_data if res.is_valid() and not res.is_income and res.description]
+        description_hashes = {res.description: generate_blind_index(res.description) for res in expense_results}
+        categorized_hash_dates = set()
+        latest_categorized_by_hash: dict[str, Transaction] = dict()
+        if description_hashes:
+            categorized_with_same_description = Transaction.objects.filter(
+                user=self.user,
+                description_hash__in=set(description_hashes.values()),
+                status='categorized'
+            )
+            # Duplicates can only fall on the dates of this chunk: read just those (hash, date) pairs
+            categorized_hash_dates = set(categorized_with_same_description.filter(
+                transaction_date__in={res.date for res in expense_results}
+            ).values_list('description_hash', 'transaction_date').order_by())
+            # The database keeps the latest categorized transaction of each description, without its raw data
+            latest_categorized = categorized_with_same_description.filter(
+                category__isnull=False, merchant__isnull=False
+            ).order_by(
+                'description_hash', F('transaction_date').desc(nulls_last=True)
+            ).distinct('description_hash').select_related('category', 'merchant').only(
+                'description_hash', 'transaction_date', 'category', 'merchant'
+            )
+            latest_categorized_by_hash = {categorized_tx.description_hash: categorized_tx
+                                          for categorized_tx in latest_categorized}
+
+        # 5. Processing Waterfall
         for tx, res in parsed_data:
             if not res.is_valid():
                 all_transactions_to_upload.append(tx)
@@ -165,18 +264,32 @@ class ExpenseUploadProcessor(SimilarityMatcherRAG):
                 continue
 
             # Check for duplicates
-            if res.description:
-                if Transaction.objects.filter(
-                        user=self.user,
-                        description_hash=generate_blind_index(res.description),
-                        transaction_date=res.date,
-                        status='categorized'
-                ).exists():
-                    all_transactions_to_delete.append(tx)
-                    continue
+            if res.description and (description_hashes[res.description], res.date) in categorized_hash_dates:
+                all_transactions_to_delete.append(tx)
+                continue
 
             # WATERFALL START
             categorized = False
+            # Every level stores the same vector: look it up once
+            tx.embedding = embedding_dict.get(res.description.strip()) if res.description else None
+
+            # Level R: User Rule (the rule names the merchant and the category, no need to ask the agent)
+            rule = self._match_local_rule(res.description) if res.description else None
+            if rule:
+                TransactionUpdater.update_categorized_transaction_with_category_merchant(tx, rule.category, rule.merchant, res)
+                if tx.embedding:
+                    ema_updates.append((rule.merchant, upload_file.file_structure_metadata, tx.embedding))
+                all_transactions_categorized.append(tx)
+                continue
+
+            # Level 0: Exact Description Match (a description already categorized on another date)
+            exact_ref = latest_categorized_by_hash.get(description_hashes[res.description]) if res.description else None
+            if exact_ref:
+                TransactionUpdater.update_categorized_transaction(tx, res, exact_ref)
+                if tx.embedding:
+                    ema_updates.append((exact_ref.merchant, upload_file.file_structure_metadata, tx.embedding))
+                all_transactions_categorized.append(tx)
+                continue
 
             # Level A: Direct Merchant Match (from our batch map)
             m_hash = generate_blind_index(res.merchant) if res.merchant else None
@@ -187,18 +300,21 @@ class ExpenseUploadProcessor(SimilarityMatcherRAG):
                 if ref_tx:
                     merchant_with_category[merchant_obj] = ref_tx
                     TransactionUpdater.update_categorized_transaction(tx, res, ref_tx)
-                    tx.embedding = embedding_dict.get(res.description.strip())
                     if tx.embedding:
-                        update_merchant_ema(merchant_obj, upload_file.file_structure_metadata, tx.embedding)
+                        ema_updates.append((merchant_obj, upload_file.file_structure_metadata, tx.embedding))
                     all_transactions_categorized.append(tx)
                     categorized = True
 
             # Level B: Vector RAG (if not found by merchant name)
             if not categorized and res.description:
-                tx.embedding = embedding_dict.get(res.description.strip())
                 if tx.embedding:
-                    # find_rag_context is inherited from SimilarityMatcherRAG
-                    final_ref = self._is_rag_context_valid(tx, res.description)
+                    rag_result = rag_result_by_description.get(res.description)
+                    if rag_result is None:
+                        # find_rag_context is inherited from SimilarityMatcherRAG
+                        final_ref = self._is_rag_context_valid(tx, res.description)
+                        rag_result_by_description[res.description] = (tx.rag_context, final_ref)
+                    else:
+                        tx.rag_context, final_ref = rag_result
                     if final_ref:
                         final_ref_most_frequent = merchant_with_category.get(final_ref.merchant)
                         if not final_ref_most_frequent:
@@ -208,17 +324,17 @@ class ExpenseUploadProcessor(SimilarityMatcherRAG):
 
                         if final_ref_most_frequent:
                             TransactionUpdater.update_categorized_transaction(tx, res, final_ref_most_frequent)
-                            update_merchant_ema(final_ref.merchant, upload_file.file_structure_metadata, tx.embedding)
+                            ema_updates.append((final_ref.merchant, upload_file.file_structure_metadata, tx.embedding))
                             all_transactions_categorized.append(tx)
                             categorized = True
 
             # Level C: Fallback to Agent
             if not categorized:
                 uncategorized_tx = TransactionUpdater.update_transaction_with_parse_result(tx, res)
-                uncategorized_tx.embedding = embedding_dict.get(res.description.strip()) if res.description else None
                 all_transactions_to_upload.append(uncategorized_tx)
 
-        # 5. Bulk Persistence
+        # 6. Bulk Persistence
+        update_merchant_emas(ema_updates)
         to_update = all_transactions_categorized + all_transactions_to_upload + all_transactions_as_income
         Transaction.objects.bulk_update(to_update, [
             'status', 'merchant', 'category', 'transaction_date',
@@ -251,16 +367,21 @@ class ExpenseUploadProcessor(SimilarityMatcherRAG):
 
         for ctx_ema in useful_context:
             merchant_name = ctx_ema.merchant.name.lower()
+            merchant_name_pattern = self._get_merchant_name_pattern(merchant_name)
             # Distance from pgvector: 0.0 is perfect, 1.0 is unrelated
             vector_distance = getattr(ctx_ema, 'distance', self.rag_max_distance)
 
             # 1. Regex Match Check
-            merchant_name_pattern = rf"\b{re.escape(merchant_name)}\b"
-            match = re.search(merchant_name_pattern, description_to_check)
+            match = merchant_name_pattern.search(description_to_check)
+            name_len = len(merchant_name)
+
+            # Short names (e.g. 'TIM') occur by chance inside long descriptions:
+            # a match is only trusted near the start, otherwise it counts as missing
+            if match and name_len <= self.rag_short_name_threshold and match.start() > self.rag_short_name_position_threshold:
+                match = None
 
             if match:
                 match_position = match.start()
-                name_len = len(merchant_name)
 
                 # DYNAMIC WEIGHTS:
                 # - Longer names (e.g., DECATHLON) get a 'trust bonus'.
@@ -292,9 +413,35 @@ class ExpenseUploadProcessor(SimilarityMatcherRAG):
 
         return final_ref
 
-    def _process_with_agent(self, batch: list[Transaction], upload_file: UploadFile) -> tuple[
-        list[TransactionCategorization], GeminiResponse | None]:
+    def _build_agent_batch(self, batch: list[Transaction]) -> tuple[list[AgentTransactionUpload], dict[str, list[int]]]:
+        """
+        Builds the agent payload of a batch, resolving the RAG examples from the database.
+        Transactions with the same description and amount are sent once: the second value maps the id of the
+        transaction sent to the ids of its duplicates, which get the same categorization.
+        """
         agent_upload_transaction = []
+        duplicate_ids: dict[str, list[int]] = {}
+        representative_by_key: dict[tuple[str, float], Transaction] = {}
+        unique_batch = []
+        for tx in batch:
+            # Only parsed transactions can be compared, the others go to the agent as they are
+            if not tx.description_hash or tx.amount is None:
+                unique_batch.append(tx)
+                continue
+            # The amount is stored unsigned (see TransactionUpdater), so a refund and a charge with the same
+            # description and value share a key. That merge is intended: income is set aside in the prechecks and
+            # never reaches the agent, and anything parsed as an expense is categorized as one whatever its sign.
+            key = (tx.description_hash, tx.amount)
+            representative = representative_by_key.get(key)
+            if representative is None:
+                representative_by_key[key] = tx
+                unique_batch.append(tx)
+            else:
+                duplicate_ids.setdefault(str(representative.id), []).append(tx.id)
+        if duplicate_ids:
+            logger.info(f"Agent batch merged {len(batch)} transactions into {len(unique_batch)} "
+                        f"(merge rate {len(unique_batch) / len(batch):.2f})")
+        batch = unique_batch
 
         # 1. Collect all unique merchants across the entire batch to avoid repeated queries
         merchant_map = {}
@@ -316,7 +463,12 @@ class ExpenseUploadProcessor(SimilarityMatcherRAG):
             # Check if we already have the context from _process_prechecks
             useful_context = getattr(tx, 'rag_context', []) or []
             rag_context_data = []
+            seen_merchant_ids = set()
             for ctx_ema in useful_context:
+                # A merchant has one EMA per file structure: its example goes in the prompt only once
+                if ctx_ema.merchant_id in seen_merchant_ids:
+                    continue
+                seen_merchant_ids.add(ctx_ema.merchant_id)
                 frequent_tx = merchant_to_frequent_tx.get(ctx_ema.merchant_id)
                 if frequent_tx:
                     rag_context_data.append({
@@ -333,20 +485,52 @@ class ExpenseUploadProcessor(SimilarityMatcherRAG):
                 )
             )
 
-        if any(agent_upload_transaction):
-            return retry_with_backoff(
-                self.agent.process_batch,
-                max_retries=self.gemini_max_retries,
-                base_delay=self.gemini_base_delay,
-                on_failure=([], None),
-                batch=agent_upload_transaction,
-                upload_file=upload_file
-            )
-
-        return [], None
+        return agent_upload_transaction, duplicate_ids
+
+    def _process_with_agent(self, agent_upload_transaction: list[AgentTransactionUpload], duplicate_ids: dict[str, list[int]],
+                            upload_file: UploadFile) -> tuple[list[TransactionCategorization], GeminiResponse | None]:
+        # Runs in the executor threads: it only talks to Gemini, all database work happens in the calling thread
+        if not any(agent_upload_transaction):
+            return [], None
+
+        categorizations, response = retry_with_backoff(
+            self.agent.process_batch,
+            max_retries=self.gemini_max_retries,
+            base_delay=self.gemini_base_delay,
+            on_failure=([], None),
+            retry_on=is_retryable_gemini_error,
+            retry_delay=gemini_retry_delay,
+            max_retry_delay=self.gemini_max_retry_delay,
+            batch=agent_upload_transaction,
+            upload_file=upload_file
+        )
+        # Duplicates keep their own date, amount and description: only category and merchant are taken from the copy
+        fanned_out = [
+            replace(categorization, transaction_id=str(duplicate_id))
+            for categorization in categorizations
+            for duplicate_id in duplicate_ids.get(str(categorization.transaction_id), [])
+        ]
+        return categorizations + fanned_out, response
 
     def _persist_batch_results(self, batch: list[TransactionCategorization], upload_file: UploadFile) -> None:
         transactions_to_update = []
+        ema_updates: list[tuple[Merchant, FileStructureMetadata, list[float]]] = []
+
+        # Prefetch what the batch refers to with one query per model, instead of one lookup per transaction
+        merchants_by_hash: dict[str, Merchant] = {}
+        merchant_hashes = {generate_blind_index(tx_data.merchant) for tx_data in batch if tx_data.merchant}
+        for merchant in Merchant.objects.filter(name_hash__in=merchant_hashes, user=self.user):
+            merchants_by_hash.setdefault(merchant.name_hash, merchant)
+        user_categories = list(Category.objects.filter(user=self.user))
+        categories_by_name: dict[str, Category | None] = {}
+        transaction_ids = {}
+        for tx_data in batch:
+            try:
+                transaction_ids[tx_data.transaction_id] = int(tx_data.transaction_id)
+            except (TypeError, ValueError):
+                continue
+        transactions_by_id = Transaction.objects.filter(user=self.user).in_bulk(set(transaction_ids.values()))
+
         for tx_data in batch:
             tx_id = tx_data.transaction_id
             try:
@@ -361,16 +545,21 @@ class ExpenseUploadProcessor(SimilarityMatcherRAG):
                     continue
 
                 merchant_hash = generate_blind_index(merchant_name)
-                merchant = Merchant.objects.filter(name_hash=merchant_hash, user=self.user).first()
+                merchant = merchants_by_hash.get(merchant_hash)
                 if not merchant:
                     merchant = Merchant.objects.create(name=merchant_name, user=self.user)
-                category = Category.objects.filter(name__icontains=category_name.strip(), user=self.user).first()
+                    merchants_by_hash[merchant_hash] = merchant
+                category_key = category_name.strip().lower()
+                if category_key not in categories_by_name:
+                    # Same pick as name__icontains(...).first() on the name-ordered categories
+                    categories_by_name[category_key] = next(
+                        (c for c in user_categories if category_key in c.name.lower()), None)
+                category = categories_by_name[category_key]
                 if not category:
                     Transaction.objects.filter(id=tx_id).update(status='uncategorized', merchant=merchant)
                     continue
 
-                transaction_from_agent = Transaction.objects.filter(user=self.user,
-                                                                   id=tx_id).first() or Transaction.objects.filter(
+                transaction_from_agent = transactions_by_id.get(transaction_ids.get(tx_id)) or Transaction.objects.filter(
                     user=self.user, description_hash=generate_blind_index(description)).first()
 
                 if not transaction_from_agent:
@@ -388,8 +577,8 @@ class ExpenseUploadProcessor(SimilarityMatcherRAG):
                     transaction_from_agent.embedding = generate_embedding(transaction_from_agent.description)
                 transaction_from_agent.description_hash = generate_blind_index(transaction_from_agent.description)
                 
-                # Update Merchant EMA
-                update_merchant_ema(merchant, upload_file.file_structure_metadata, transaction_from_agent.embedding)
+                # Update Merchant EMA (written with the batch below)
+                ema_updates.append((merchant, upload_file.file_structure_metadata, transaction_from_agent.embedding))
                 
                 transactions_to_update.append(transaction_from_agent)
 
@@ -403,6 +592,7 @@ class ExpenseUploadProcessor(SimilarityMatcherRAG):
                 'transaction_date', 'amount', 'status', 'modified_by_user',
                 'description', 'description_hash', 'categorized_by_agent', 'embedding'
             ])
+        update_merchant_emas(ema_updates)
 
 
 
@@ -431,6 +621,7 @@ class ExpenseUploadProcessor(SimilarityMatcherRAG):
             if not chunk:
                 break
 
+            ema_updates: list[tuple[Merchant, FileStructureMetadata, list[float]]] = []
             for tx in chunk:
                 parse_result = parse_raw_transaction(tx.raw_data, [upload_file])
                 if not parse_result.is_valid():
@@ -452,7 +643,7 @@ class ExpenseUploadProcessor(SimilarityMatcherRAG):
                             if ref_tx:
                                 TransactionUpdater.update_categorized_transaction(tx, parse_result, ref_tx)
                                 # Update EMA since we found a reliable match
-                                update_merchant_ema(final_ref.merchant, upload_file.file_structure_metadata, tx.embedding)
+                                ema_updates.append((final_ref.merchant, upload_file.file_structure_metadata, tx.embedding))
                             else:
                                 tx.status = 'uncategorized'
                         else:
@@ -467,6 +658,7 @@ class ExpenseUploadProcessor(SimilarityMatcherRAG):
                 ['transaction_date', 'amount', 'description', 'description_hash',
                  'category', 'status', 'merchant', 'embedding']
             )
+            update_merchant_emas(ema_updates)
 
         Transaction.objects.filter(user=self.user, upload_file=upload_file, status__in=['pending', 'uncategorized'],
                                    amount__isnull=True).update(status='uncategorized',
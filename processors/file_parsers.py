@@ -3,16 +3,25 @@ File parsers for transaction uploads.
 Handles CSV and Excel file parsing with automatic format detection,
 header hunting, and smart footer cropping.
 """
+import csv
 import os
 import logging
 import io
+import re
 import pandas as pd
-from typing import List, Dict, Optional, Tuple, Any
+from typing import List, Dict, Optional, Tuple
 from django.db.models import Q
 from api.models import FileStructureMetadata
 
 logger = logging.getLogger(__name__)
 
+# Cell values that are treated as missing once stringified
+NULL_PLACEHOLDERS = ('', 'nan', 'nat', 'none', 'null')
+# Column names that look like a date column ('Data contabile', 'Booking Date', ...)
+DATE_COLUMN_PATTERN = re.compile(r'dat[ae]', re.IGNORECASE)
+# Separators accepted when sniffing a CSV
+CSV_DELIMITERS = ';,\t|'
+
 class FileParserError(Exception):
     """Exception raised for file parsing errors"""
     pass
@@ -66,20 +75,20 @@ def _process_file_smartly(file, is_excel: bool) -> List[Dict[str, str]]:
             else:
                 text_content = content
 
-            # Use io.StringIO to create a file-like object for pandas
-            preview_io = io.StringIO(text_content)
+            # Only the decoded text is needed from here on: release the raw bytes, and give pandas
+            # a single io.StringIO that is rewound for the full read
+            del content
+            file_io = io.StringIO(text_content)
 
-            # Try sniffing separator or default to auto
+            # Sniff the separator once, then both reads use the C engine with it
+            sep = _sniff_csv_separator(text_content)
             try:
-                sep = None # Pandas 'python' engine detects it automatically
-                df_preview = pd.read_csv(preview_io, sep=sep, header=None, nrows=30, engine='python')
+                df_preview = pd.read_csv(file_io, sep=sep, header=None, nrows=30)
             except Exception:
                 # Fallback for strict separators
-                preview_io.seek(0)
-                df_preview = pd.read_csv(preview_io, sep=';', header=None, nrows=30)
-
-            # Prepare full file wrapper for later
-            file_io = io.StringIO(text_content)
+                sep = ';'
+                file_io.seek(0)
+                df_preview = pd.read_csv(file_io, sep=sep, header=None, nrows=30)
 
     except Exception as e:
         raise FileParserError(f"Failed to read file preview: {e}")
@@ -93,7 +102,7 @@ def _process_file_smartly(file, is_excel: bool) -> List[Dict[str, str]]:
             df = pd.read_excel(file, header=header_index)
         else:
             file_io.seek(0) # Reset buffer
-            df = pd.read_csv(file_io, header=header_index, sep=None, engine='python')
+            df = pd.read_csv(file_io, header=header_index, sep=sep)
     except Exception as e:
         raise FileParserError(f"Failed to load full data with header at row {header_index}: {e}")
 
@@ -109,6 +118,19 @@ def _process_file_smartly(file, is_excel: bool) -> List[Dict[str, str]]:
     return _clean_dataframe_to_dict(df)
 
 
+def _sniff_csv_separator(text_content: str) -> str:
+    """
+    Detects the CSV separator from the first non-empty line, as pandas' python engine does with sep=None,
+    restricted to real CSV delimiters so a plain title line cannot elect a letter as separator.
+    Falls back to ';' (the usual Italian bank export separator) when the line is not delimited.
+    """
+    first_line = next((line for line in io.StringIO(text_content) if line.strip()), '')
+    try:
+        return csv.Sniffer().sniff(first_line, delimiters=CSV_DELIMITERS).delimiter
+    except csv.Error:
+        return ';'
+
+
 def _find_header_row(df_preview: pd.DataFrame) -> Tuple[int, Optional[FileStructureMetadata]]:
     """
     Identifies the header row index.
@@ -121,25 +143,30 @@ def _find_header_row(df_preview: pd.DataFrame) -> Tuple[int, Optional[FileStruct
         description_column_name__isnull=False
     )
 
+    # Build the required column set of each metadata once, instead of once per preview row
+    required_cols_by_metadata = []
+    for metadata in valid_metadata:
+        required_cols = {metadata.date_column_name, metadata.description_column_name}
+        # Add amount columns if they exist in metadata
+        if metadata.expense_amount_column_name: required_cols.add(metadata.expense_amount_column_name)
+        if metadata.income_amount_column_name: required_cols.add(metadata.income_amount_column_name)
+        required_cols_by_metadata.append((frozenset(required_cols), metadata))
+
+    # Get the clean list of values of each row once, for both strategies (no per-row Series boxing)
+    preview_rows = [
+        (index, [cell for val in values if val is not None and (cell := str(val).strip())])
+        for index, *values in df_preview.astype(object).where(df_preview.notna(), None).itertuples(name=None)
+    ]
+
     # A. METADATA MATCHING STRATEGY
-    for index, row in df_preview.iterrows():
-        # Get clean list of values in this row
-        row_values = [str(val).strip() for val in row.dropna().tolist() if str(val).strip()]
+    for index, row_values in preview_rows:
         if not row_values: continue
 
         row_values_set = set(row_values)
 
-        for metadata in valid_metadata:
-            required_cols = [
-                metadata.date_column_name,
-                metadata.description_column_name
-            ]
-            # Add amount columns if they exist in metadata
-            if metadata.expense_amount_column_name: required_cols.append(metadata.expense_amount_column_name)
-            if metadata.income_amount_column_name: required_cols.append(metadata.income_amount_column_name)
-
+        for required_cols, metadata in required_cols_by_metadata:
             # Check if ALL required columns are present in this row
-            if all(col in row_values_set for col in required_cols):
+            if required_cols <= row_values_set:
                 logger.info(f"✅ Header found at row {index} via Metadata: {metadata}")
                 return index, metadata
 
@@ -148,16 +175,15 @@ def _find_header_row(df_preview: pd.DataFrame) -> Tuple[int, Optional[FileStruct
     logger.info("⚠️ No Metadata match. Switching to Keyword Heuristic.")
 
     keywords = os.getenv('BANK_KEYWORDS', 'data,valuta,descrizione,importo,entrate,uscite,contabile').split(',')
-    keywords = [k.strip().lower() for k in keywords if k.strip()]
+    keywords = frozenset(k.strip().lower() for k in keywords if k.strip())
 
     best_score = 0
     best_index = -1
 
-    for index, row in df_preview.iterrows():
-        row_values = [str(val).strip().lower() for val in row.dropna().tolist()]
-        row_values = set([word for val in row_values for word in val.split()])
-        # Count how many keywords appear in this row
-        score = sum(1 for val in row_values if val in keywords)
+    for index, row_values in preview_rows:
+        row_values = {word for val in row_values for word in val.lower().split()}
+        # Count how many keywords appear in this row (one set intersection instead of a scan per word)
+        score = len(row_values & keywords)
 
         # We need at least 2 keywords to be confident (e.g. "Data" and "Importo")
         if score >= 2 and score > best_score:
@@ -186,10 +212,7 @@ def _crop_footer_smartly(df: pd.DataFrame, metadata: Optional[FileStructureMetad
         date_col = metadata.date_column_name
     else:
         # Heuristic search for date column
-        for col in df.columns:
-            if 'data' in col.lower() or 'date' in col.lower():
-                date_col = col
-                break
+        date_col = next((col for col in df.columns if DATE_COLUMN_PATTERN.search(col)), None)
 
     if not date_col:
         logger.warning("Could not identify Date column for smart cropping. Falling back to simple dropna.")
@@ -221,32 +244,21 @@ def _clean_dataframe_to_dict(df: pd.DataFrame) -> List[Dict[str, str]]:
     Final cleaning to ensure JSON compliance for Postgres.
     Converts NaNs to None, dates to strings, strips whitespace.
     """
-    def clean_cell(x: Any) -> str | None:
-        if x is None: return None
-        if pd.isna(x): return None # Handle NaN/NaT
-
-        s = str(x).strip()
-        if not s or s.lower() in ('nan', 'nat', 'none', 'null'):
-            return None
-        return s
-
     # Process columns
     for col in df.columns:
         # Format Timestamps explicitly if pandas recognized them
         if pd.api.types.is_datetime64_any_dtype(df[col]):
             df[col] = df[col].dt.strftime('%d/%m/%Y')
 
-        # Apply strict cleaning
-        df[col] = df[col].apply(clean_cell)
+        # Apply strict cleaning column-wise: stringify and strip the non-null cells,
+        # then drop the empty ones and the textual null placeholders (they become NaN on reindex)
+        values = df[col]
+        cleaned = values[values.notna()].astype(str).str.strip()
+        cleaned = cleaned[~cleaned.str.lower().isin(NULL_PLACEHOLDERS)]
+        df[col] = cleaned.reindex(df.index)
 
     # Remove rows that became completely empty after cleaning
     df = df.dropna(how='all')
 
     # Convert to list of dicts and ENSURE no NaNs are left (Postgres JSONField compatibility)
-    records = df.to_dict('records')
-    for record in records:
-        for key, value in record.items():
-            if pd.isna(value):
-                record[key] = None
-
-    return records
\ No newline at end of file
+    return df.astype(object).where(df.notna(), None).to_dict('records')
@@ -2,6 +2,7 @@ import os
 import re
 from datetime import date, datetime
 from decimal import Decimal, InvalidOperation
+from functools import lru_cache
 
 default_date_formats = [
     '%d/%m/%Y',  # DD/MM/YYYY
@@ -28,6 +29,10 @@ default_amount_pattern = re.compile(
 )
 amount_pattern = os.getenv('PARSE_AMOUNT_PATTERN', default_amount_pattern)
 
+# Single-pass translations for amount normalization
+amount_cleanup_table = str.maketrans('', '', '€$ ')  # currency symbols and spaces
+italian_decimal_table = str.maketrans({'.': None, ',': '.'})  # 1.234,56 -> 1234.56
+
 # Common word separators
 separators = [' ', ';', ',', '\t', '|', '\n']
 
@@ -59,7 +64,7 @@ def normalize_amount(amount_value: str | float | int | None) -> Decimal | None:
     if isinstance(amount_value, str):
         # 2. Cleanup
         # Remove currency symbols and spaces first.
-        cleaned = amount_value.replace('€', '').replace('$', '').replace(' ', '').strip()
+        cleaned = amount_value.translate(amount_cleanup_table).strip()
 
         if not cleaned or cleaned.lower() in ('nan', 'none'):
             return None
@@ -72,7 +77,7 @@ def normalize_amount(amount_value: str | float | int | None) -> Decimal | None:
             if cleaned.rfind(',') > cleaned.rfind('.'):
                 # Input is Italian: dot is thousands separator, comma is decimal
                 # Example: "1.234,56" -> remove dots, replace comma with dot -> "1234.56"
-                standardized = cleaned.replace('.', '').replace(',', '.')
+                standardized = cleaned.translate(italian_decimal_table)
             else:
                 # Input is International: comma is thousands separator, dot is decimal
                 # Example: "1,234.56" -> remove commas -> "1234.56"
@@ -130,17 +135,20 @@ def _split_by_separators(text: str, separators: list[str]) -> list[str]:
     Returns:
         list[str]: List of words
     """
-    # Replace all separators with a single separator, then split
-    result = text
-    for sep in separators:
-        result = result.replace(sep, '|||')
+    # Split on any of the separators in a single pass
+    return _compile_separators(tuple(separators)).split(text)
+
 
-    return result.split('|||')
+@lru_cache(maxsize=None)
+def _compile_separators(separators: tuple[str, ...]) -> re.Pattern:
+    return re.compile('|'.join(re.escape(sep) for sep in separators))
 
 
+@lru_cache(maxsize=4096)
 def _try_parse_date(word: str) -> date | None:
     """
     Try to parse a word as a date using various formats.
+    Results are cached: statement rows share few distinct dates, and a miss tries every format.
 
     Args:
         word: Word to parse as date
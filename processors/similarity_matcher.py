@@ -1,8 +1,10 @@
 import logging
 import os
+from typing import Iterable
 
 from django.contrib.auth.models import User
 from django.db.models import Count, Max
+from django.utils import timezone
 
 from api.models import Transaction, Merchant, FileStructureMetadata, MerchantEMA
 from processors.embeddings import EmbeddingEngine
@@ -34,7 +36,70 @@ def update_merchant_ema(merchant: Merchant, file_structure_metadata: FileStructu
         # EMA Formula: OLD_WEIGHT * old + NEW_WEIGHT * new
         updated_ema = EMA_OLD_WEIGHT * old_ema + EMA_NEW_WEIGHT * new_vec
         ema_obj.digital_footprint = updated_ema.tolist()
-        ema_obj.save()
+        # Only the footprint changes: write that column (and the auto_now timestamp) instead of the whole row
+        ema_obj.save(update_fields=['digital_footprint', 'updated_at'])
+
+
+def update_merchant_emas(updates: Iterable[tuple[Merchant, FileStructureMetadata, list[float]]]) -> None:
+    """
+    Applies many EMA updates at once: one read of the touched EMAs, one bulk update and one bulk create.
+    Updates of the same merchant and file structure are folded in order, exactly as repeated
+    update_merchant_ema calls would, so only the final footprint is written.
+    """
+    import numpy as np
+    embeddings_by_key: dict[tuple[int, int], list[list[float]]] = {}
+    targets: dict[tuple[int, int], tuple[Merchant, FileStructureMetadata]] = {}
+    for merchant, file_structure_metadata, embedding in updates:
+        if embedding is None or not any(embedding) or not merchant or not file_structure_metadata:
+            continue
+        key = (merchant.pk, file_structure_metadata.pk)
+        embeddings_by_key.setdefault(key, []).append(embedding)
+        targets[key] = (merchant, file_structure_metadata)
+
+    if not embeddings_by_key:
+        return
+
+    existing_emas = {
+        (ema.merchant_id, ema.file_structure_metadata_id): ema
+        for ema in MerchantEMA.objects.filter(
+            merchant_id__in={merchant_id for merchant_id, _ in embeddings_by_key},
+            file_structure_metadata_id__in={metadata_id for _, metadata_id in embeddings_by_key}
+        )
+    }
+
+    emas_to_update = []
+    emas_to_create = []
+    now = timezone.now()
+    for key, embeddings in embeddings_by_key.items():
+        ema_obj = existing_emas.get(key)
+        if ema_obj is None:
+            # A new EMA starts from the first embedding, as get_or_create does in update_merchant_ema
+            footprint = np.array(embeddings[0])
+            embeddings = embeddings[1:]
+        else:
+            footprint = np.array(ema_obj.digital_footprint)
+
+        for embedding in embeddings:
+            # EMA Formula: OLD_WEIGHT * old + NEW_WEIGHT * new
+            footprint = EMA_OLD_WEIGHT * footprint + EMA_NEW_WEIGHT * np.array(embedding)
+
+        if ema_obj is None:
+            merchant, file_structure_metadata = targets[key]
+            emas_to_create.append(MerchantEMA(
+                merchant=merchant,
+                file_structure_metadata=file_structure_metadata,
+                digital_footprint=footprint.tolist()
+            ))
+        else:
+            ema_obj.digital_footprint = footprint.tolist()
+            # bulk_update skips auto_now fields
+            ema_obj.updated_at = now
+            emas_to_update.append(ema_obj)
+
+    if emas_to_update:
+        MerchantEMA.objects.bulk_update(emas_to_update, ['digital_footprint', 'updated_at'])
+    if emas_to_create:
+        MerchantEMA.objects.bulk_create(emas_to_create)
 
 
 def generate_embedding(description: str) -> list[float]:
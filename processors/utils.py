@@ -13,6 +13,9 @@ def retry_with_backoff[T](
     base_delay: float | None = None,
     exceptions: Type[Exception] | Iterable[Type[Exception]] = Exception,
     on_failure: Any | Callable[[], Any] = None,
+    retry_on: Callable[[Exception], bool] | None = None,
+    retry_delay: Callable[[Exception], float | None] | None = None,
+    max_retry_delay: float | None = None,
     *args: Any,
     **kwargs: Any
 ) -> T:
@@ -24,6 +27,11 @@ def retry_with_backoff[T](
     :param base_delay: Base delay for backoff in seconds. If None, uses RETRY_BASE_DELAY env var (default: 2).
     :param exceptions: Exception or tuple of exceptions to catch.
     :param on_failure: Value to return or callable to execute when all retries fail. If None, the last exception is raised.
+    :param retry_on: Predicate on a caught exception, False when retrying cannot help (the failure is then final).
+    :param retry_delay: Returns the delay requested by the failing service for a caught exception, if any.
+        The wait before the next attempt is never shorter than it.
+    :param max_retry_delay: Longest wait between attempts in seconds. A service asking for a longer delay fails
+        immediately instead of blocking the caller. If None, uses RETRY_MAX_DELAY env var (default: 60).
     :param args: Positional arguments for func.
     :param kwargs: Keyword arguments for func.
     :return: The result of func or on_failure.
@@ -32,23 +40,33 @@ def retry_with_backoff[T](
         max_retries = int(os.environ.get('RETRY_MAX_RETRIES', 5))
     if base_delay is None:
         base_delay = float(os.environ.get('RETRY_BASE_DELAY', 2))
+    if max_retry_delay is None:
+        max_retry_delay = float(os.environ.get('RETRY_MAX_DELAY', 60))
         
     for attempt in range(max_retries):
         try:
             return func(*args, **kwargs)
         except exceptions as e:
-            is_last_attempt = (attempt == max_retries - 1)
+            requested_delay = retry_delay(e) if retry_delay is not None else None
+            is_last_attempt = (
+                attempt == max_retries - 1
+                or (retry_on is not None and not retry_on(e))
+                or (requested_delay is not None and requested_delay > max_retry_delay)
+            )
             
             if is_last_attempt:
-                logger.error(f"⚠️ {func.__name__} failed after {max_retries} attempts: {str(e)}")
+                logger.error(f"⚠️ {func.__name__} failed after {attempt + 1} attempts: {str(e)}")
                 if on_failure is not None:
                     if callable(on_failure):
                         return on_failure()
                     return on_failure
                 raise e
             
-            # Exponential backoff with Jitter
+            # Exponential backoff with Jitter, never below the requested delay nor above the maximum
             sleep_time = (base_delay * (2 ** attempt)) + random.uniform(0, 1)
+            if requested_delay is not None:
+                sleep_time = max(sleep_time, requested_delay)
+            sleep_time = min(sleep_time, max_retry_delay)
             logger.warning(
                 f"⚠️ {func.__name__} Error (Attempt {attempt + 1}/{max_retries}). "
                 f"Retrying in {sleep_time:.2f}s... Error: {str(e)}"